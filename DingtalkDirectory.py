@@ -0,0 +1,92 @@
+# -*- coding:utf-8 -*-
+
+class DingtalkDirectory:
+    """
+    钉钉成员目录，基于DB-API连接(pymysql或sqlite3)读取dingtalk_members表
+    """
+    COLUMNS = ('email', 'name', 'userid', 'avatar')
+
+    def __init__(self, connection, table='dingtalk_members', cursor_factory=None, paramstyle='format'):
+        """
+        :param connection: 数据库连接
+        :param table: 成员表名
+        :param cursor_factory: 创建流式游标的函数，pymysql下为lambda conn: conn.cursor(pymysql.cursors.SSCursor)
+        :param paramstyle: 参数占位符风格，pymysql为'format'(%s)，sqlite3为'qmark'(?)
+        """
+        self.connection = connection
+        self.table = table
+        self.cursor_factory = cursor_factory or (lambda conn: conn.cursor())
+        self.placeholder = '?' if paramstyle == 'qmark' else '%s'
+
+    @classmethod
+    def from_pymysql(cls, connection, table='dingtalk_members'):
+        """
+        使用pymysql的服务端游标(SSCursor)，结果逐行读取，不在客户端缓存整个结果集
+        :param connection:
+        :param table:
+        :return:
+        """
+        import pymysql
+        return cls(connection, table, cursor_factory=lambda conn: conn.cursor(pymysql.cursors.SSCursor), paramstyle='format')
+
+    @classmethod
+    def from_sqlite(cls, connection, table='dingtalk_members'):
+        """
+        使用sqlite3连接，用于本地测试
+        :param connection:
+        :param table:
+        :return:
+        """
+        return cls(connection, table, paramstyle='qmark')
+
+    def _select(self):
+        return 'select {} from {}'.format(', '.join(self.COLUMNS), self.table)
+
+    @staticmethod
+    def _to_member(columns, row):
+        member = dict(zip(columns, row)) if not isinstance(row, dict) else dict(row)
+        if isinstance(member.get('name'), bytes):
+            member['name'] = member['name'].decode('utf-8')
+        return member
+
+    def iter_members(self, batch_size=1000):
+        """
+        流式读取所有成员
+        :param batch_size: 每次从游标读取的行数
+        :return: 逐个返回成员信息字典
+        """
+        cursor = self.cursor_factory(self.connection)
+        try:
+            cursor.execute(self._select())
+            columns = [d[0] for d in cursor.description]
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield self._to_member(columns, row)
+        finally:
+            cursor.close()
+
+    def lookup(self, emails, batch_size=500):
+        """
+        按邮箱批量查询成员(where email in (...))
+        :param emails: 邮箱列表
+        :param batch_size: 每次查询的邮箱数量
+        :return: {email: 成员信息}
+        """
+        emails = list(set(emails))
+        members = {}
+        for i in range(0, len(emails), batch_size):
+            batch = emails[i:i + batch_size]
+            sql = '{} where email in ({})'.format(self._select(), ', '.join([self.placeholder] * len(batch)))
+            cursor = self.connection.cursor()
+            try:
+                cursor.execute(sql, batch)
+                columns = [d[0] for d in cursor.description]
+                for row in cursor.fetchall():
+                    member = self._to_member(columns, row)
+                    members[member['email']] = member
+            finally:
+                cursor.close()
+        return members
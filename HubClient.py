@@ -4,6 +4,14 @@ import requests
 from common import copy_dict
 from common import ClientError, AuthError, ValidationError, ServerError
 import base64
+import time
+import array
+import threading
+import collections
+from multiprocessing.pool import ThreadPool
+from deadline import RequestMetrics, hedged_call
+from token_auth import make_auth
+import codec
 
 class HubClient:
     RULES_USERS_ENDPOINT = '/api/rest/users'
@@ -15,18 +23,37 @@ class HubClient:
     RULES_PROJECT_ROLES_ENDPOINT = '/api/rest/projectroles'
     RULES_RESOURCES_ENDPOINT = '/api/rest/resources'
 
-    def __init__(self, hub_url = None, username = None, password = None, token=None):
+    def __init__(self, hub_url = None, username = None, password = None, token=None, timeout=(10, 60), deadline=None, hedge=False, transport=None):
         """
         Set connection info and session, including auth (if username + password
         and/or auth token were provided).
+
+        :param token: Hub permanent token, or a requests auth object such as
+                      token_auth.ClientCredentialsAuth; used instead of
+                      username + password when given
+        :param timeout: per-request timeout in seconds or (connect, read) tuple
+        :param deadline: optional deadline.Deadline for the whole run; request
+                         timeouts are capped to the time remaining
+        :param hedge: send a duplicate GET when the first one is slower than
+                      the recent p95 latency, and use whichever returns first
+        :param transport: optional session-like transport such as
+                          transport.Http2Transport; defaults to a
+                          requests.Session
         """
         self._url = hub_url
-        self._session = requests.Session()
+        self._session = transport if transport is not None else requests.Session()
+        self.timeout = timeout
+        self.deadline = deadline
+        self.hedge = hedge
+        self.metrics = RequestMetrics()
 
         #: Headers that will be used in request to Hub
         self.headers = {}
 
-        if username and password:
+        self._http_auth = None
+        if token is not None:
+            self._http_auth = make_auth(token)
+        elif username and password:
              self._http_auth = requests.auth.HTTPBasicAuth(username, password)
 
     def __repr__(self):
@@ -84,14 +111,30 @@ class HubClient:
         # We need to deal with json vs. data when uploading files
         if files:
             data = post_data
-            json = None
             del opts["headers"]["Content-type"]
+        elif post_data is not None:
+            # Encode the body with the configured codec instead of requests' json=
+            data = codec.dumps(post_data)
         else:
-            json = post_data
             data = None
 
-        result = self._session.request(verb, url, json=json, data=data, params=params,
-                               files=files, **opts)
+        timeout = self.deadline.timeout(self.timeout) if self.deadline else self.timeout
+
+        def send():
+            started = time.time()
+            try:
+                result = self._session.request(verb, url, data=data, params=params,
+                                               files=files, timeout=timeout, **opts)
+            except requests.exceptions.Timeout:
+                self.metrics.incr('timeouts')
+                raise
+            self.metrics.observe(time.time() - started)
+            return result
+
+        if verb == 'get' and self.hedge:
+            result = hedged_call(send, self.metrics.percentile(95), self.metrics)
+        else:
+            result = send()
         self.__check_response(result)
         return result
 
@@ -183,29 +226,42 @@ class HubClient:
         """
         Auto-iterate over the paginated results of various methods of the API.
         Pass the http method as the first argument, followed by the
-        other parameters as normal. Include `page` to determine first page to poll.
-        Remaining kwargs are passed on to the called method, including `per_page`.
+        other parameters as normal. The caller's `params` (which must include
+        `$top` and may include `$skip` to start at an offset) are copied, so
+        they are never modified.
 
         :param fn: Actual method to call
-        :param page: Optional, page number to start at, defaults to 0
+        :param params: Query parameters of the listing
+        :param search_key: Key of the result list in the response
         :param args: Positional arguments to actual method
         :param kwargs: Keyword arguments to actual method
-        :return: Yields each item in the result until exhausted, and then implicit StopIteration; or no elements if error
+        :return: Paginator yielding each item in the result until exhausted
         """
-        skip = 0
-        while True:
-            params['$skip'] = skip
-            results = fn(*args, **kwargs)
+        kwargs.pop('query_data', None)
+        return Paginator(fn, search_key, params, *args, **kwargs)
 
-            skip += params['$top']
-            if search_key in results.json():
-                for prj in results.json()[search_key]:
-                    yield prj
+    def paginate(self, endpoint, search_key, fields=None, top=100, skip=0):
+        """
+        Create a resumable paginator over a listing endpoint
+        :param endpoint:
+        :param search_key:
+        :param fields:
+        :param top: page size
+        :param skip: offset to start at
+        :return: Paginator
+        """
+        params = {'$top': top, '$skip': skip}
+        if fields:
+            params['fields'] = fields
+        return Paginator(self.http_get, search_key, params, endpoint)
 
-                if len(results.json()[search_key]) != params['$top']:
-                    break
-            else:
-                break
+    def resume(self, state):
+        """
+        Resume a listing from Paginator.state()
+        :param state:
+        :return: Paginator
+        """
+        return Paginator.from_state(self.http_get, state)
 
     def get_user(self, user_id, fields=None):
         """
@@ -218,12 +274,13 @@ class HubClient:
         if fields:
             params['fields'] = fields
         resp = self.http_get(self.RULES_USERS_ENDPOINT + '/' + user_id, query_data=params)
-        return resp.json()
+        return codec.response_json(resp)
 
-    def get_all_users(self, fields=None):
+    def get_all_users(self, fields=None, order_by=None):
         """
         获取所有用户信息
         :param fields:
+        :param order_by: 排序字段，如'login'
         :return:
         """
         top = 100
@@ -232,6 +289,8 @@ class HubClient:
         }
         if fields:
             params['fields'] = fields
+        if order_by:
+            params['$orderBy'] = order_by
         return self.getall(self.http_get, params, 'users', self.RULES_USERS_ENDPOINT, query_data=params)
 
     def create_user(self, login, name, profile, VCSUserNames, fields=None):
@@ -256,7 +315,7 @@ class HubClient:
             params['fields'] = fields
 
         res = self.http_post(self.RULES_USERS_ENDPOINT, query_data=params, post_data=user_data)
-        return res.json()
+        return codec.response_json(res)
 
     def update_existing_user(self, user_id, user_data):
         """
@@ -303,6 +362,97 @@ class HubClient:
         user_info['profile']['email']['verified'] = email_verified
         self.http_post(self.RULES_USERS_ENDPOINT + '/' + user_id, post_data=user_info)
 
+    def invite_user(self, invitation, fields=None):
+        """
+        邀请用户
+        :param invitation: 邀请信息，如{'email': 'user@example.com'}
+        :param fields:
+        :return:
+        """
+        params = {}
+        if fields:
+            params['fields'] = fields
+        res = self.http_post(self.RULES_USERS_INVITE_ENDPOINT, query_data=params, post_data=invitation)
+        return codec.response_json(res) if res.content else None
+
+    def merge_users(self, target_user_id, source_user_id):
+        """
+        将source用户合并到target用户，合并后source用户被删除
+        :param target_user_id: 保留的用户
+        :param source_user_id: 被合并的用户
+        :return:
+        """
+        merge_data = {
+            'target': {'id': target_user_id},
+            'source': {'id': source_user_id}
+        }
+        self.http_post(self.RULES_USERS_MERGE_ENDPOINT, post_data=merge_data)
+
+    @staticmethod
+    def _run_batch(fn, groups, processes):
+        """
+        并发执行分组的操作，组内按顺序串行执行
+        :param fn: fn(item)
+        :param groups: [[item]]
+        :param processes: 并发请求数
+        :return: {'succeeded': [item], 'failed': [(item, error)]}
+        """
+        def run_group(group):
+            succeeded, failed = [], []
+            for item in group:
+                try:
+                    fn(item)
+                    succeeded.append(item)
+                except Exception as e:
+                    failed.append((item, e))
+            return succeeded, failed
+
+        report = {'succeeded': [], 'failed': []}
+        groups = [g for g in groups if g]
+        if not groups:
+            return report
+        pool = ThreadPool(min(processes, len(groups)))
+        try:
+            for succeeded, failed in pool.imap(run_group, groups):
+                report['succeeded'].extend(succeeded)
+                report['failed'].extend(failed)
+        finally:
+            pool.close()
+            pool.join()
+        return report
+
+    def invite_users(self, invitations, processes=8):
+        """
+        批量邀请用户，同一邮箱只邀请一次
+        :param invitations: 邮箱或邀请信息的列表
+        :param processes: 并发请求数
+        :return: {'succeeded': [invitation], 'failed': [(invitation, error)]}
+        """
+        unique = collections.OrderedDict()
+        for invitation in invitations:
+            if not isinstance(invitation, dict):
+                invitation = {'email': invitation}
+            unique.setdefault(invitation['email'].strip().lower(), invitation)
+        return self._run_batch(self.invite_user, [[i] for i in unique.values()], processes)
+
+    def merge_users_batch(self, merges, processes=8):
+        """
+        批量合并用户
+        合并到同一target用户的操作按顺序串行执行，不同target的合并并发执行
+        :param merges: [(target_user_id, source_user_id)]
+        :param processes: 并发请求数
+        :return: {'succeeded': [merge], 'failed': [(merge, error)]}
+        """
+        sources = set(source for _, source in merges)
+        for target, source in merges:
+            if target == source or target in sources:
+                raise ValueError('User {} cannot be both merged and kept'.format(target))
+
+        ordered = collections.OrderedDict()
+        for merge in merges:
+            ordered.setdefault(merge[0], []).append(merge)
+        return self._run_batch(lambda merge: self.merge_users(*merge), ordered.values(), processes)
+
     def get_groups_of_user(self, user_id, fields=None):
         """
         Get All Groups of a User
@@ -329,7 +479,7 @@ class HubClient:
         if fields:
             params['fields'] = fields
         resp = self.http_get(self.RULES_USERGROUPS_ENDPOINT + '/' + user_group_id, query_data=params)
-        return resp.json()
+        return codec.response_json(resp)
 
     def get_all_user_groups(self, fields=None):
         """
@@ -357,7 +507,7 @@ class HubClient:
             params['fields'] = fields
 
         response = self.http_post(self.RULES_USERGROUPS_ENDPOINT, query_data=params, post_data=user_group)
-        return response.json()
+        return codec.response_json(response)
 
     def delete_user_group(self, user_group_id):
         """
@@ -391,6 +541,38 @@ class HubClient:
             params['fields'] = fields
         return self.getall(self.http_get, params, 'users', self.RULES_USERGROUPS_ENDPOINT + '/' + user_group_id + '/users', query_data=params)
 
+    def build_membership_index(self, user_groups=None, processes=8):
+        """
+        并发读取所有用户组的成员，建立双向的成员关系索引
+        :param user_groups: 需要索引的用户组[{'id', 'name'}]，默认为所有用户组
+        :param processes: 并发请求数
+        :return: MembershipIndex
+        """
+        if user_groups is None:
+            user_groups = self.get_all_user_groups(fields='id,name')
+        user_groups = list(user_groups)
+        index = MembershipIndex()
+
+        def load_members(group):
+            try:
+                return group, list(self.get_users_of_user_group(group['id'], fields='id,login')), None
+            except Exception as e:
+                return group, None, e
+
+        if not user_groups:
+            return index
+        pool = ThreadPool(min(processes, len(user_groups)))
+        try:
+            for group, members, error in pool.imap_unordered(load_members, user_groups):
+                if error is not None:
+                    index.failed.append((group['name'], error))
+                else:
+                    index.add_group(group, members)
+        finally:
+            pool.close()
+            pool.join()
+        return index
+
     def get_user_from_users_of_user_group(self, user_group_id, user_id, fields=None):
         """
         Get User from Users of a User Group
@@ -403,7 +585,7 @@ class HubClient:
         if fields:
             params['fields'] = fields
         resp = self.http_get(self.RULES_USERGROUPS_ENDPOINT + '/' + user_group_id + '/users/' + user_id, query_data=params)
-        return resp.json()
+        return codec.response_json(resp)
 
     def add_user_to_users_of_user_group(self, user_group_id, user):
         """
@@ -447,6 +629,15 @@ class HubClient:
         """
         self.http_post(self.RULES_USERGROUPS_ENDPOINT + '/' + usergroup_id + '/projectroles', post_data=project_role)
 
+    def delete_project_role_from_project_roles_of_usergroup(self, usergroup_id, project_role_id):
+        """
+        Remove Project Role from Project Roles of a User Group
+        :param usergroup_id:
+        :param project_role_id:
+        :return:
+        """
+        self.http_delete(self.RULES_USERGROUPS_ENDPOINT + '/' + usergroup_id + '/projectroles/' + project_role_id)
+
     def get_project(self, project_id, fields=None):
         """
         获取指定project的信息
@@ -458,7 +649,7 @@ class HubClient:
         if fields:
             params['fields'] = fields
         resp = self.http_get(self.RULES_PROJECTS_ENDPOINT + '/' + project_id, query_data=params)
-        return resp.json()
+        return codec.response_json(resp)
 
     def get_all_projects(self, fields=None):
         """
@@ -502,7 +693,7 @@ class HubClient:
             params['fields'] = fields
 
         res = self.http_post(self.RULES_PROJECTS_ENDPOINT, query_data=params, post_data=project_data)
-        return res.json()
+        return codec.response_json(res)
 
     def update_existing_project(self, project_id, project_data):
         """
@@ -587,4 +778,156 @@ class HubClient:
         if fields:
             params['fields'] = fields
         resp = self.http_get(self.RULES_PROJECTS_ENDPOINT + '/' + project_id + '/transitiveprojectroles/' + project_role_id, query_data=params)
-        return resp.json()
+        return codec.response_json(resp)
+
+
+class Paginator:
+    """
+    Iterator over a paginated Hub listing that owns its cursor state.
+
+    Items can be consumed from several threads at once; each item is
+    returned exactly once. state() returns a JSON-serializable checkpoint
+    whose `$skip` points at the first item not yet returned, so a scan can
+    be resumed with Paginator.from_state().
+    """
+
+    def __init__(self, fn, search_key, params, *args, **kwargs):
+        self._fn = fn
+        self._search_key = search_key
+        self._params = dict(params)
+        self._args = args
+        self._kwargs = kwargs
+        self._top = self._params['$top']
+        self._skip = self._params.pop('$skip', 0)
+        self._buffer = []
+        self._exhausted = False
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_state(cls, fn, state):
+        params = dict(state['params'])
+        params['$skip'] = state['skip']
+        return cls(fn, state['search_key'], params, *state['args'])
+
+    def state(self):
+        """
+        Checkpoint of the listing
+        :return: dict with search_key, params, args and skip
+        """
+        with self._lock:
+            return {
+                'search_key': self._search_key,
+                'params': dict(self._params),
+                'args': list(self._args),
+                'skip': self._skip - len(self._buffer),
+            }
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self._lock:
+            if not self._buffer and not self._exhausted:
+                self._fetch_page()
+            if not self._buffer:
+                raise StopIteration
+            return self._buffer.pop(0)
+
+    next = __next__
+
+    def _fetch_page(self):
+        page_params = dict(self._params)
+        page_params['$skip'] = self._skip
+        results = codec.response_json(self._fn(*self._args, query_data=page_params, **self._kwargs))
+        items = results.get(self._search_key, [])
+        self._skip += len(items)
+        self._buffer = list(items)
+        if len(items) != self._top:
+            self._exhausted = True
+
+
+class MembershipIndex:
+    """
+    Two-way index of user group membership built from one scan of the
+    groups' member lists (see HubClient.build_membership_index()).
+
+    Logins and group names are interned to integers; each direction is a
+    dict of integer -> array('i') so a full directory stays compact.
+    Groups whose member list could not be read are listed in `failed` and
+    are not indexed.
+    """
+
+    def __init__(self):
+        self._logins = []
+        self._user_ids = []
+        self._user_index = {}
+        self._group_names = []
+        self._group_ids = []
+        self._group_index = {}
+        self._group_users = {}
+        self._user_groups = {}
+        self.failed = []
+
+    def _intern_user(self, user):
+        i = self._user_index.get(user['login'])
+        if i is None:
+            i = self._user_index[user['login']] = len(self._logins)
+            self._logins.append(user['login'])
+            self._user_ids.append(user.get('id'))
+        return i
+
+    def add_group(self, group, members):
+        """
+        Index the members of one group
+        :param group: dict with id and name
+        :param members: users with id and login
+        :return:
+        """
+        g = self._group_index.get(group['name'])
+        if g is None:
+            g = self._group_index[group['name']] = len(self._group_names)
+            self._group_names.append(group['name'])
+            self._group_ids.append(group['id'])
+        users = array.array('i', sorted(set(self._intern_user(u) for u in members)))
+        self._group_users[g] = users
+        for u in users:
+            self._user_groups.setdefault(u, array.array('i')).append(g)
+
+    def __contains__(self, group_name):
+        return group_name in self._group_index
+
+    def group_names(self):
+        return list(self._group_names)
+
+    def group_id(self, group_name):
+        return self._group_ids[self._group_index[group_name]]
+
+    def user_id(self, login):
+        return self._user_ids[self._user_index[login]]
+
+    def users_of(self, group_name):
+        """
+        Logins of the members of a group
+        :param group_name:
+        :return: list of logins; KeyError if the group is not indexed
+        """
+        return [self._logins[u] for u in self._group_users[self._group_index[group_name]]]
+
+    def groups_of(self, login):
+        """
+        Names of the indexed groups a user belongs to
+        :param login:
+        :return: list of group names, empty for users in no indexed group
+        """
+        u = self._user_index.get(login)
+        if u is None:
+            return []
+        return [self._group_names[g] for g in self._user_groups.get(u, ())]
+
+    def summary(self):
+        return {
+            'groups': len(self._group_names),
+            'users': len(self._logins),
+            'memberships': sum(len(users) for users in self._group_users.values()),
+            'failed': len(self.failed),
+        }
@@ -1,6 +1,12 @@
 #-*- coding:utf-8 -*-
-import json
+import time
+import threading
+import collections
+from multiprocessing.pool import ThreadPool
 import requests
+from deadline import RequestMetrics, hedged_call
+from token_auth import make_auth
+import codec
 
 class ConnectionError(Exception):
     pass
@@ -8,24 +14,75 @@ class ConnectionError(Exception):
 # Makes HTTP requests to the Upsource API
 
 class UpsourceClient:
-    def __init__(self, base_url, username, password):
+    #: getUserInfo单次请求的用户id数量
+    USER_INFO_BATCH_SIZE = 100
+    #: 用户信息LRU缓存容量
+    USER_INFO_CACHE_SIZE = 10000
+
+    def __init__(self, base_url, username, password, timeout=(10, 60), deadline=None, hedge=False, transport=None, token=None):
+        """
+        :param base_url:
+        :param username:
+        :param password:
+        :param timeout: 单次请求超时秒数或(connect, read)元组
+        :param deadline: 整体运行截止时间(deadline.Deadline)，请求超时不超过剩余时间
+        :param hedge: GET请求超过最近p95耗时仍未返回时再发起一次，使用先返回的结果
+        :param transport: 与requests.Session.request接口相同的传输层，如transport.Http2Transport，默认使用requests
+        :param token: Hub永久令牌或requests认证对象(如token_auth.ClientCredentialsAuth)，设置时不使用用户名密码
+        """
         self.base_url = base_url
         self.url = base_url + '/~rpc/'
-        self.auth = (username, password)
+        self.auth = make_auth(token) if token is not None else (username, password)
         self.headers = {'Content-Type': 'application/json'}
+        self.timeout = timeout
+        self.deadline = deadline
+        self.hedge = hedge
+        self.metrics = RequestMetrics()
+        self.transport = transport
+        self._user_info_cache = collections.OrderedDict()
+        self._user_info_lock = threading.Lock()
 
     def __repr__(self):
         return '{}'.format(self.base_url)
 
-    def GET(self, method, request=None):
-        response = requests.get(self.url + method, auth=self.auth, params={'params': json.dumps(request)} if request else '')
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_user_info_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._user_info_lock = threading.Lock()
+
+    def _request(self, method, url, **kwargs):
+        timeout = self.deadline.timeout(self.timeout) if self.deadline else self.timeout
+
+        def send():
+            started = time.time()
+            try:
+                sender = self.transport if self.transport is not None else requests
+                response = sender.request(method, url, auth=self.auth, timeout=timeout, **kwargs)
+            except requests.exceptions.Timeout:
+                self.metrics.incr('timeouts')
+                raise
+            self.metrics.observe(time.time() - started)
+            return response
+
+        if method == 'get' and self.hedge:
+            response = hedged_call(send, self.metrics.percentile(95), self.metrics)
+        else:
+            response = send()
         self.__check_response(response)
-        if 'result' in response.json():
-            return response.json()['result']
+        return response
+
+    def GET(self, method, request=None):
+        response = self._request('get', self.url + method, params={'params': codec.dumps_str(request)} if request else '')
+        result = codec.response_json(response)
+        if 'result' in result:
+            return result['result']
 
     def POST(self, method, data):
-        response = requests.post(self.url + method, auth=self.auth, headers=self.headers, data=json.dumps(data))
-        self.__check_response(response)
+        self._request('post', self.url + method, headers=self.headers, data=codec.dumps(data))
 
     @staticmethod
     def __check_response(response):
@@ -56,6 +113,16 @@ class UpsourceClient:
             project_names = []
         return project_names
 
+    def get_projects_readiness(self):
+        """
+        获取所有项目的索引状态
+        :return: {project_id: isReady}
+        """
+        projects = self.GET('getAllProjects')
+        if projects:
+            return {project['projectId']: project.get('isReady', False) for project in projects['project']}
+        return {}
+
     def get_project_attribute(self, project_id):
         """
         获取项目属性(其中包含归属组信息)
@@ -114,29 +181,128 @@ class UpsourceClient:
         :param user_id:
         :return:
         """
-        infos = self.GET('getUserInfo', {'ids': user_id})['infos'][0]
-        if 'login' in infos:
-            return infos
+        return self.load_users_info([user_id]).get(user_id)
+
+    def load_users_info(self, user_ids, batch_size=None, processes=4):
+        """
+        批量获取用户信息，按batch_size拆分getUserInfo请求并发执行，结果写入LRU缓存
+        :param user_ids: 用户id列表
+        :param batch_size: 单次请求的id数量
+        :param processes: 并发请求数
+        :return: {user_id: info}，不存在的用户值为None
+        """
+        batch_size = batch_size or self.USER_INFO_BATCH_SIZE
+        result = {}
+        missing = []
+        with self._user_info_lock:
+            for user_id in user_ids:
+                if user_id in result:
+                    continue
+                if user_id in self._user_info_cache:
+                    info = self._user_info_cache.pop(user_id)
+                    self._user_info_cache[user_id] = info
+                    result[user_id] = info
+                else:
+                    result[user_id] = None
+                    missing.append(user_id)
+
+        if not missing:
+            return result
+
+        batches = [missing[i:i + batch_size] for i in range(0, len(missing), batch_size)]
+        if len(batches) == 1 or processes <= 1:
+            responses = [self._get_user_info_batch(batch) for batch in batches]
         else:
-            return None
+            pool = ThreadPool(min(processes, len(batches)))
+            try:
+                responses = pool.map(self._get_user_info_batch, batches)
+            finally:
+                pool.close()
+                pool.join()
 
-    def add_user_to_project(self, project_id, user_id):
+        with self._user_info_lock:
+            for batch, infos in zip(batches, responses):
+                for user_id, info in zip(batch, infos):
+                    info = info if 'login' in info else None
+                    result[user_id] = info
+                    self._user_info_cache[user_id] = info
+            while len(self._user_info_cache) > self.USER_INFO_CACHE_SIZE:
+                self._user_info_cache.popitem(last=False)
+        return result
+
+    def _get_user_info_batch(self, user_ids):
+        response = self.GET('getUserInfo', {'ids': user_ids})
+        return response['infos'] if response else []
+
+    def add_user_to_project(self, project_id, user_id, role_key='developer'):
         """
         将用户添加到项目中
         :param project_id:
         :param user_id:
+        :param role_key:
         :return:
         """
-        self.POST('addUserRole', {'projectId': project_id, 'userId': user_id, 'roleKey': 'developer'})
+        self.POST('addUserRole', {'projectId': project_id, 'userId': user_id, 'roleKey': role_key})
 
-    def delete_user_from_project(self, project_id, user_id):
+    def delete_user_from_project(self, project_id, user_id, role_key='developer'):
         """
         将用户从项目中移除
         :param project_id:
         :param user_id:
+        :param role_key:
         :return:
         """
-        self.POST('deleteUserRole', {'projectId': project_id, 'userId': user_id, 'roleKey': 'developer'})
+        self.POST('deleteUserRole', {'projectId': project_id, 'userId': user_id, 'roleKey': role_key})
+
+    def apply_user_role_changes(self, changes, processes=8, per_project=False, pool=None):
+        """
+        批量修改项目中的用户权限
+        默认按(项目, 用户)保证顺序：同一项目内同一用户的变更按提交顺序串行执行，其余变更并发执行。
+        addUserRole/deleteUserRole只修改单个用户在项目中的角色，结果只取决于该用户自身变更的先后，
+        不同用户之间没有依赖；按项目串行会使300人的大项目逐个请求执行，失去批量并发的意义
+        :param changes: [(action, project_id, user_id, role_key)]，action为'add'或'delete'
+        :param processes: 并发请求数，传入pool时不使用
+        :param per_project: 为True时同一项目的所有变更按提交顺序串行执行，只有不同项目之间并发
+        :param pool: 共用的线程池，多个调用方并发调用时限制总的并发请求数；为None时每次调用创建线程池
+        :return: {'succeeded': [change], 'failed': [(change, error)]}
+        """
+        operations = {'add': self.add_user_to_project, 'delete': self.delete_user_from_project}
+        for change in changes:
+            if change[0] not in operations:
+                raise ValueError('Unknown role change action: {}'.format(change[0]))
+
+        # 按(项目, 用户)或项目分组，保证组内顺序
+        ordered = collections.OrderedDict()
+        for change in changes:
+            key = change[1] if per_project else (change[1], change[2])
+            ordered.setdefault(key, []).append(change)
+
+        def apply_group(group):
+            succeeded, failed = [], []
+            for change in group:
+                action, project_id, user_id, role_key = change
+                try:
+                    operations[action](project_id, user_id, role_key)
+                    succeeded.append(change)
+                except Exception as e:
+                    failed.append((change, e))
+            return succeeded, failed
+
+        report = {'succeeded': [], 'failed': []}
+        if not ordered:
+            return report
+        own_pool = pool is None
+        if own_pool:
+            pool = ThreadPool(min(processes, len(ordered)))
+        try:
+            for succeeded, failed in pool.imap(apply_group, ordered.values()):
+                report['succeeded'].extend(succeeded)
+                report['failed'].extend(failed)
+        finally:
+            if own_pool:
+                pool.close()
+                pool.join()
+        return report
 
     def load_user_roles_in_project(self, project_id):
         """
@@ -146,3 +312,314 @@ class UpsourceClient:
         """
         user_roles = self.GET('getUsersRoles', {'projectId': project_id, 'offset': 0, 'pageSize': 1000})
         return user_roles
+
+
+class ReadinessFuture:
+    """
+    单个项目的就绪状态，结果为True(就绪)或False(超时)
+    """
+    def __init__(self, project_id):
+        self.project_id = project_id
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._ready = None
+        self._done = False
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        """
+        等待项目就绪
+        :param timeout: 最长等待秒数
+        :return: True/False，等待超时返回None
+        """
+        self._event.wait(timeout)
+        return self._ready
+
+    def add_done_callback(self, fn):
+        """
+        注册回调fn(project_id, ready)，已完成时立即调用
+        :param fn:
+        :return:
+        """
+        with self._lock:
+            if not self._done:
+                self._callbacks.append(fn)
+                return
+        fn(self.project_id, self._ready)
+
+    def _set_result(self, ready):
+        with self._lock:
+            self._ready = ready
+            self._done = True
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self.project_id, ready)
+            except Exception as e:
+                print('Readiness callback for {} failed: {}'.format(self.project_id, e))
+        # 回调执行完后再唤醒等待者
+        self._event.set()
+
+
+class ProjectReadinessTracker:
+    """
+    在后台线程中通过一次getAllProjects请求同时跟踪多个项目的索引状态，
+    没有项目就绪时轮询间隔按backoff递增，直到max_interval
+    """
+    def __init__(self, client, min_interval=2, max_interval=30, backoff=1.5, timeout=300):
+        self.client = client
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.timeout = timeout
+        self._pending = {}
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def watch(self, project_id, callback=None, timeout=None, settle=0):
+        """
+        开始跟踪项目
+        :param project_id:
+        :param callback: 项目就绪或超时后调用callback(project_id, ready)
+        :param timeout: 超时秒数，默认使用self.timeout
+        :param settle: 重置项目后索引可能尚未开始，isReady为True时需要先观察到索引中，
+                       或者开始跟踪已超过settle秒，才认为项目就绪
+        :return: ReadinessFuture
+        """
+        with self._lock:
+            future = self._futures.get(project_id)
+            if future is None or future.done():
+                future = ReadinessFuture(project_id)
+                self._futures[project_id] = future
+                now = time.time()
+                deadline = now + (timeout if timeout is not None else self.timeout)
+                # [future, 超时时间, settle截止时间, 是否观察到索引中]
+                self._pending[project_id] = [future, deadline, now + settle, False]
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='upsource-readiness')
+                self._thread.daemon = True
+                self._thread.start()
+        if callback:
+            future.add_done_callback(callback)
+        return future
+
+    def pending(self):
+        """
+        仍在等待索引完成的项目
+        :return:
+        """
+        with self._lock:
+            return list(self._pending)
+
+    def wait(self, timeout=None):
+        """
+        等待所有已跟踪的项目完成
+        :param timeout: 最长等待秒数
+        :return: {project_id: True/False/None}
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._lock:
+            futures = list(self._futures.values())
+        for future in futures:
+            future.result(None if deadline is None else max(0, deadline - time.time()))
+        return {future.project_id: future.result(0) for future in futures}
+
+    def _run(self):
+        interval = self.min_interval
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._thread = None
+                    return
+            try:
+                readiness = self.client.get_projects_readiness()
+            except Exception as e:
+                print('Failed to poll project readiness: {}'.format(e))
+                readiness = {}
+
+            now = time.time()
+            resolved = []
+            with self._lock:
+                for project_id, entry in list(self._pending.items()):
+                    future, deadline, settle_until, seen_indexing = entry
+                    if readiness.get(project_id) is False:
+                        entry[3] = True
+                    if readiness.get(project_id) and (seen_indexing or now >= settle_until):
+                        resolved.append((future, True))
+                    elif now >= deadline:
+                        resolved.append((future, False))
+                    else:
+                        continue
+                    del self._pending[project_id]
+            for future, ready in resolved:
+                future._set_result(ready)
+
+            if any(ready for _, ready in resolved):
+                interval = self.min_interval
+            else:
+                interval = min(interval * self.backoff, self.max_interval)
+            time.sleep(interval)
+
+
+class ProjectCreationPipeline:
+    """
+    并发创建项目，同时处于索引中的项目数不超过max_indexing，
+    项目就绪(或等待超时)后再创建下一个，创建失败时重试retries次
+    """
+    #: 输出中的操作名称
+    action = 'Create'
+
+    def __init__(self, client, max_indexing=5, retries=2, retry_delay=10, readiness_timeout=1800, tracker=None, settle=0):
+        self.client = client
+        self.max_indexing = max_indexing
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.readiness_timeout = readiness_timeout
+        self.settle = settle
+        self.tracker = tracker or ProjectReadinessTracker(client)
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._queued = 0
+        self._started = None
+        self._ready = []
+        self._timed_out = []
+        self._failed = []
+
+    def stats(self):
+        """
+        当前进度：排队数、创建/索引中数量、完成数量、吞吐量(个/分钟)和预计剩余秒数
+        :return:
+        """
+        with self._condition:
+            elapsed = time.time() - self._started if self._started else 0
+            finished = len(self._ready) + len(self._timed_out) + len(self._failed)
+            remaining = self._queued + self._in_flight
+            return {
+                'queued': self._queued,
+                'in_flight': self._in_flight,
+                'ready': len(self._ready),
+                'timed_out': len(self._timed_out),
+                'failed': len(self._failed),
+                'elapsed': elapsed,
+                'throughput': len(self._ready) * 60.0 / elapsed if elapsed else 0.0,
+                'eta': remaining * elapsed / finished if finished else None,
+            }
+
+    def run(self, projects, report_interval=60):
+        """
+        创建项目并等待全部完成
+        :param projects: [(project_id, project_settings)]
+        :param report_interval: 输出进度的间隔秒数
+        :return: {'ready': [project_id], 'timed_out': [project_id], 'failed': [(project_id, error)]}
+        """
+        projects = list(projects)
+        self._started = time.time()
+        self._queued = len(projects)
+        last_report = time.time()
+        pool = ThreadPool(self.max_indexing)
+        try:
+            for project_id, project_settings in projects:
+                with self._condition:
+                    while self._in_flight >= self.max_indexing:
+                        self._condition.wait(report_interval)
+                        if time.time() - last_report >= report_interval:
+                            self._report()
+                            last_report = time.time()
+                    self._queued -= 1
+                    self._in_flight += 1
+                pool.apply_async(self._start, (project_id, project_settings))
+
+            with self._condition:
+                while self._in_flight:
+                    self._condition.wait(report_interval)
+                    if time.time() - last_report >= report_interval:
+                        self._report()
+                        last_report = time.time()
+        finally:
+            pool.close()
+            pool.join()
+        self._report()
+        return {'ready': list(self._ready), 'timed_out': list(self._timed_out), 'failed': list(self._failed)}
+
+    def _report(self):
+        stats = self.stats()
+        stats['eta'] = '{:.0f}min'.format(stats['eta'] / 60) if stats['eta'] is not None else '-'
+        print('Projects queued: {queued}, in flight: {in_flight}, ready: {ready}, timed out: {timed_out}, '
+              'failed: {failed}, throughput: {throughput:.2f}/min, ETA: {eta}'.format(**stats))
+
+    def _submit(self, project_id, project_settings):
+        self.client.create_project(project_id, project_settings)
+
+    def _start(self, project_id, payload):
+        # 在线程池中执行，apply_async不会传出异常，未处理的异常计为失败，避免run()一直等待
+        try:
+            self._process(project_id, payload)
+        except Exception as e:
+            print('{} project {} failed: {}'.format(self.action, project_id, e))
+            self._finish(self._failed, (project_id, e))
+
+    def _process(self, project_id, payload):
+        for attempt in range(self.retries + 1):
+            try:
+                self._submit(project_id, payload)
+                print('{} project {}'.format(self.action, project_id))
+                break
+            except Exception as e:
+                if attempt == self.retries:
+                    print('{} project {} failed: {}'.format(self.action, project_id, e))
+                    self._finish(self._failed, (project_id, e))
+                    return
+                time.sleep(self.retry_delay * (attempt + 1))
+        self.tracker.watch(project_id, callback=self._on_ready, timeout=self.readiness_timeout, settle=self.settle)
+
+    def _on_ready(self, project_id, ready):
+        if ready:
+            print('Project {} is ready'.format(project_id))
+            self._finish(self._ready, project_id)
+        else:
+            print('Project {} is still indexing'.format(project_id))
+            self._finish(self._timed_out, project_id)
+
+    def _finish(self, results, item):
+        with self._condition:
+            results.append(item)
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+
+class ProjectReindexScheduler(ProjectCreationPipeline):
+    """
+    批量重置项目(重新索引)，同时索引中的项目不超过max_indexing，
+    最近活跃的项目优先；重置后需观察到索引中或等待settle秒后isReady才视为完成
+    """
+    action = 'Reset'
+
+    def __init__(self, client, max_indexing=5, retries=2, retry_delay=10, readiness_timeout=7200, tracker=None, settle=60):
+        ProjectCreationPipeline.__init__(self, client, max_indexing=max_indexing, retries=retries, retry_delay=retry_delay,
+                                         readiness_timeout=readiness_timeout, tracker=tracker, settle=settle)
+
+    @staticmethod
+    def prioritize(projects):
+        """
+        按最近活跃时间降序排列，没有活跃时间的项目排在最后
+        :param projects: [(project_id, last_activity)]，last_activity可比较(如'2020-01-01')或为None
+        :return: [project_id]
+        """
+        active = sorted([p for p in projects if p[1] is not None], key=lambda p: p[1], reverse=True)
+        return [p[0] for p in active] + [p[0] for p in projects if p[1] is None]
+
+    def run(self, projects, report_interval=60):
+        """
+        重置项目并等待全部重新索引完成
+        :param projects: [(project_id, last_activity)]
+        :param report_interval: 输出进度的间隔秒数
+        :return: {'ready': [project_id], 'timed_out': [project_id], 'failed': [(project_id, error)]}
+        """
+        return ProjectCreationPipeline.run(self, [(project_id, None) for project_id in self.prioritize(projects)], report_interval)
+
+    def _submit(self, project_id, payload):
+        self.client.reset_project(project_id)
@@ -0,0 +1,55 @@
+# -*- coding:utf-8 -*-
+
+"""
+CLI冷启动耗时：在新进程中执行python cli.py --help，超过预算或导入了重量级模块时返回非0
+用法: python benchmarks/bench_cli_startup.py [预算(毫秒)] [运行次数]
+"""
+
+import os
+import sys
+import time
+import subprocess
+
+CLI_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cli.py')
+
+# 只应在执行子命令时导入的模块
+HEAVY_MODULES = ['requests', 'pymysql', 'gitlab_api', 'jenkins_api', 'multiprocessing', 'sqlite3', 'json']
+
+CHECK_IMPORTS = (
+    "import sys; sys.argv = ['cli.py', '--help']; sys.path.insert(0, {path!r})\n"
+    "try:\n"
+    "    import cli; cli.main()\n"
+    "except SystemExit:\n"
+    "    pass\n"
+    "print('loaded:' + ','.join(m for m in {modules!r} if m in sys.modules))\n"
+)
+
+def cold_start(runs):
+    """
+    多次冷启动取最小耗时
+    :param runs:
+    :return: 秒
+    """
+    timings = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            started = time.time()
+            subprocess.check_call([sys.executable, CLI_PATH, '--help'], stdout=devnull)
+            timings.append(time.time() - started)
+    return min(timings)
+
+def heavy_imports():
+    code = CHECK_IMPORTS.format(path=os.path.dirname(os.path.abspath(CLI_PATH)), modules=HEAVY_MODULES)
+    output = subprocess.check_output([sys.executable, '-c', code]).decode('utf-8')
+    loaded = [line for line in output.splitlines() if line.startswith('loaded:')][-1][len('loaded:'):]
+    return [m for m in loaded.split(',') if m]
+
+if __name__ == '__main__':
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else 150
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    elapsed = cold_start(runs) * 1000
+    loaded = heavy_imports()
+    print('cli.py --help: {:.1f}ms (best of {}, budget {:.0f}ms)'.format(elapsed, runs, budget))
+    if loaded:
+        print('heavy modules imported at startup: {}'.format(', '.join(loaded)))
+    sys.exit(1 if elapsed > budget or loaded else 0)
@@ -0,0 +1,72 @@
+# -*- coding:utf-8 -*-
+
+"""
+对比各JSON库编解码Hub和Upsource响应的耗时，使用与真实接口相同结构的数据
+用法: python benchmarks/bench_codec.py [数据量] [重复次数]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import codec
+
+def hub_users_page(count):
+    # GET /api/rest/users?fields=id,login,name,profile(email,avatar),groups(id,name)
+    return {
+        'type': 'UserPage',
+        'skip': 0,
+        'top': count,
+        'total': count,
+        'users': [{
+            'type': 'user',
+            'id': '{:08x}-4e78-4714-abae-f50bdbb7fd3a'.format(i),
+            'login': 'user{}'.format(i),
+            'name': u'用户{}'.format(i),
+            'banned': False,
+            'guest': False,
+            'profile': {
+                'email': {'type': 'EmailJSON', 'verified': True, 'email': 'user{}@example.com'.format(i)},
+                'avatar': {'type': 'urlavatar', 'url': 'http://upsource.example.work/hub/api/rest/avatar/{}'.format(i)},
+            },
+            'groups': [{'id': '{:08x}-team'.format(g), 'name': 'group{}-team'.format(g)} for g in range(i % 5 + 1)],
+        } for i in range(count)],
+    }
+
+def upsource_projects(count):
+    # getAllProjects
+    return {'result': {'project': [{
+        'projectId': 'group{}-project{}'.format(i % 50, i),
+        'projectName': 'group{}/project{}'.format(i % 50, i),
+        'headHash': '{:040x}'.format(i * 2654435761),
+        'codeReviewIdPattern': 'PR-{}-{{}}'.format(i),
+        'isReady': i % 7 != 0,
+        'defaultBranch': 'master',
+        'lastCommitDate': 1790000000000 + i * 1000,
+        'lastCommitAuthorName': 'user{}'.format(i % 300),
+        'projectModelType': {'id': 'maven'},
+    } for i in range(count)]}}
+
+def bench(c, payload, repeat):
+    encoded = c.dumps(payload)
+    started = time.time()
+    for _ in range(repeat):
+        c.dumps(payload)
+    dumps_time = time.time() - started
+    started = time.time()
+    for _ in range(repeat):
+        c.loads(encoded)
+    loads_time = time.time() - started
+    assert c.loads(encoded) == payload
+    return dumps_time, loads_time, len(encoded)
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    payloads = [('hub users page', hub_users_page(count)), ('upsource projects', upsource_projects(count))]
+    for label, payload in payloads:
+        for c in codec.available_codecs():
+            dumps_time, loads_time, size = bench(c, payload, repeat)
+            print('{:<18} {:<10} dumps {:>8.2f}ms  loads {:>8.2f}ms  ({} bytes)'.format(
+                label, c.name, dumps_time * 1000 / repeat, loads_time * 1000 / repeat, size))
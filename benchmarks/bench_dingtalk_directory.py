@@ -0,0 +1,91 @@
+# -*- coding:utf-8 -*-
+
+"""
+使用SQLite作为钉钉成员库的本地替身，检查DingtalkDirectory的批量查询和流式读取，
+并对比一次读取整表(fetchall)与按邮箱批量查询的耗时和内存峰值
+用法: python benchmarks/bench_dingtalk_directory.py [成员数] [查询邮箱数] [每批邮箱数]
+"""
+
+import os
+import sys
+import time
+import sqlite3
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from DingtalkDirectory import DingtalkDirectory
+
+def create_members(members_count):
+    connection = sqlite3.connect(':memory:')
+    connection.execute('create table dingtalk_members (email text primary key, name text, userid text, avatar text)')
+    connection.executemany('insert into dingtalk_members values (?, ?, ?, ?)', [
+        ('user{}@example.com'.format(i), u'用户{}'.format(i), 'ding{}'.format(i), 'https://static.example.com/avatar/{}.jpg'.format(i))
+        for i in range(members_count)])
+    connection.commit()
+    return connection
+
+def measure(fn):
+    """
+    执行fn，返回(结果, 秒, 内存峰值字节数)，python2下不统计内存
+    """
+    if tracemalloc is not None:
+        tracemalloc.start()
+    started = time.time()
+    value = fn()
+    elapsed = time.time() - started
+    peak = None
+    if tracemalloc is not None:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return value, elapsed, peak
+
+def fetch_all(connection):
+    # 原update_hub_users.py的做法：读取整表并建立字典
+    cursor = connection.cursor()
+    cursor.execute('select email, name, userid, avatar from dingtalk_members')
+    members = {row[0]: {'name': row[1], 'userid': row[2], 'avatar': row[3]} for row in cursor.fetchall()}
+    cursor.close()
+    return members
+
+def check_lookup(directory, members_count, lookup_count, batch_size):
+    # 跨越多个批次，包含重复邮箱和库中不存在的邮箱
+    emails = ['user{}@example.com'.format(i) for i in range(0, members_count, max(1, members_count // lookup_count))][:lookup_count]
+    missing = ['missing{}@example.com'.format(i) for i in range(10)]
+    members = directory.lookup(emails + emails[:10] + missing, batch_size=batch_size)
+    assert sorted(members) == sorted(emails), 'lookup returned {} members, expected {}'.format(len(members), len(emails))
+    for email in emails:
+        assert members[email]['avatar'].endswith('/{}.jpg'.format(email[len('user'):-len('@example.com')]))
+    return members
+
+def check_iter_members(directory, members_count, batch_size):
+    count = 0
+    for member in directory.iter_members(batch_size=batch_size):
+        assert set(member) == set(DingtalkDirectory.COLUMNS)
+        count += 1
+    assert count == members_count, 'iter_members returned {} members, expected {}'.format(count, members_count)
+    return count
+
+def report(label, elapsed, peak):
+    memory = '{:.1f}MB peak'.format(peak / 1024.0 / 1024) if peak is not None else 'memory not measured'
+    print('{:<38} {:.3f}s, {}'.format(label, elapsed, memory))
+
+if __name__ == '__main__':
+    members_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    lookup_count = int(sys.argv[2]) if len(sys.argv) > 2 else 1200
+    batch_size = int(sys.argv[3]) if len(sys.argv) > 3 else 500
+
+    connection = create_members(members_count)
+    directory = DingtalkDirectory.from_sqlite(connection)
+
+    _, elapsed, peak = measure(lambda: fetch_all(connection))
+    report('fetchall whole table', elapsed, peak)
+    _, elapsed, peak = measure(lambda: check_lookup(directory, members_count, lookup_count, batch_size))
+    report('lookup {} emails (batch {})'.format(lookup_count, batch_size), elapsed, peak)
+    _, elapsed, peak = measure(lambda: check_iter_members(directory, members_count, 1000))
+    report('iter_members (fetchmany 1000)', elapsed, peak)
+    connection.close()
+    print('lookup and iter_members checks passed ({} members)'.format(members_count))
@@ -0,0 +1,152 @@
+# -*- coding:utf-8 -*-
+
+"""
+对比HTTP/1.1(requests)与HTTP/2(transport.Http2Transport)并发发送小请求的吞吐量
+在子进程中启动两个模拟反向代理的服务：HTTP/1.1多线程服务和HTTP/2(h2c)服务，
+每个请求固定延迟后返回JSON，每个新连接额外延迟一段时间模拟TCP/TLS握手
+需要安装httpx[http2](仅支持python3)
+用法: python benchmarks/bench_http2_transport.py [请求数] [并发线程数] [服务端延迟(毫秒)] [建立连接延迟(毫秒)]
+"""
+
+import os
+import sys
+import time
+import socket
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from transport import Http2Transport
+
+BODY = b'{"result":{"project":[' + b','.join([b'{"projectId":"group-project%d","isReady":true}' % i for i in range(20)]) + b']}}'
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+def start_http1_server(delay, connect_delay):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            time.sleep(connect_delay)
+            BaseHTTPRequestHandler.setup(self)
+
+        def do_GET(self):
+            time.sleep(delay)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(BODY)))
+            self.end_headers()
+            self.wfile.write(BODY)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, server.server_address[1]
+
+def start_http2_server(delay, connect_delay):
+    # 基于h2的最小HTTP/2(h2c, prior knowledge)服务，在单独线程的事件循环中运行
+    import asyncio
+    import h2.config
+    import h2.connection
+    import h2.events
+
+    class H2Protocol(asyncio.Protocol):
+        def connection_made(self, transport):
+            self.transport = transport
+            self.conn = h2.connection.H2Connection(config=h2.config.H2Configuration(client_side=False))
+            self.pending = []
+            self.started = False
+            loop.call_later(connect_delay, self.start)
+
+        def start(self):
+            self.started = True
+            self.conn.initiate_connection()
+            self.transport.write(self.conn.data_to_send())
+            for data in self.pending:
+                self.data_received(data)
+
+        def data_received(self, data):
+            if not self.started:
+                self.pending.append(data)
+                return
+            for event in self.conn.receive_data(data):
+                if isinstance(event, h2.events.StreamEnded):
+                    loop.call_later(delay, self.respond, event.stream_id)
+            self.transport.write(self.conn.data_to_send())
+
+        def respond(self, stream_id):
+            self.conn.send_headers(stream_id, [(':status', '200'), ('content-type', 'application/json'),
+                                               ('content-length', str(len(BODY)))])
+            self.conn.send_data(stream_id, BODY, end_stream=True)
+            self.transport.write(self.conn.data_to_send())
+
+    loop = asyncio.new_event_loop()
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    server = loop.run_until_complete(loop.create_server(H2Protocol, sock=sock, backlog=256))
+    thread = threading.Thread(target=loop.run_forever)
+    thread.daemon = True
+    thread.start()
+    return server, sock.getsockname()[1]
+
+def run_servers(delay, connect_delay, ports):
+    # 服务端在子进程中运行，不与客户端争用GIL
+    _, http1_port = start_http1_server(delay, connect_delay)
+    _, http2_port = start_http2_server(delay, connect_delay)
+    ports.put((http1_port, http2_port))
+    while True:
+        time.sleep(3600)
+
+def bench(label, session, url, requests_count, workers):
+    def send(_):
+        response = session.request('get', url, params={'params': '{}'}, timeout=(10, 60))
+        assert response.status_code == 200 and response.content == BODY
+    send(None)
+    started = time.time()
+    pool = ThreadPool(workers)
+    try:
+        pool.map(send, range(requests_count))
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - started
+    print('{:<34} {} requests, {} threads: {:.2f}s ({:.0f} req/s)'.format(label, requests_count, workers, elapsed, requests_count / elapsed))
+
+if __name__ == '__main__':
+    requests_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    delay = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.005
+    connect_delay = float(sys.argv[4]) / 1000 if len(sys.argv) > 4 else 0.02
+
+    ports = multiprocessing.Queue()
+    servers = multiprocessing.Process(target=run_servers, args=(delay, connect_delay, ports))
+    servers.daemon = True
+    servers.start()
+    http1_port, http2_port = ports.get()
+    http1_url = 'http://127.0.0.1:{}/~rpc/getAllProjects'.format(http1_port)
+    http2_url = 'http://127.0.0.1:{}/~rpc/getAllProjects'.format(http2_port)
+
+    # UpsourceClient默认每个请求单独建立连接，HubClient默认使用requests.Session的连接池
+    bench('HTTP/1.1 requests.request', requests, http1_url, requests_count, workers)
+    bench('HTTP/1.1 requests.Session', requests.Session(), http1_url, requests_count, workers)
+    for connections in (1, 4):
+        transport = Http2Transport(max_connections=connections, prior_knowledge=True)
+        bench('HTTP/2 Http2Transport ({} conn)'.format(connections), transport, http2_url, requests_count, workers)
+        transport.close()
+    servers.terminate()
@@ -0,0 +1,49 @@
+# -*- coding:utf-8 -*-
+
+"""
+对比multiprocessing.Pool + Manager().dict()与SyncExecutor + LockedDict执行同步任务的耗时
+用法: python benchmarks/bench_sync_executor.py [任务数] [每个任务的I/O耗时(秒)]
+"""
+
+import os
+import sys
+import time
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from executor import SyncExecutor, LockedDict
+
+WORKERS = 8
+
+def sync_task(name, shared, io_time):
+    # 模拟一次team同步：读取共享的用户组、若干次HTTP请求、写回新建的用户组
+    for _ in range(5):
+        shared.get(name)
+    time.sleep(io_time)
+    shared[name + '-team'] = name
+    return name
+
+def bench_pool_manager(names, io_time):
+    shared = multiprocessing.Manager().dict()
+    started = time.time()
+    pool = multiprocessing.Pool(WORKERS)
+    for name in names:
+        pool.apply_async(sync_task, args=(name, shared, io_time))
+    pool.close()
+    pool.join()
+    return time.time() - started, len(shared)
+
+def bench_executor(names, io_time):
+    shared = LockedDict()
+    started = time.time()
+    results = SyncExecutor(WORKERS).run(sync_task, names, shared, io_time)
+    assert not [r for r in results if r.error]
+    return time.time() - started, len(shared)
+
+if __name__ == '__main__':
+    tasks = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    io_time = float(sys.argv[2]) if len(sys.argv) > 2 else 0.02
+    names = ['group{}'.format(i) for i in range(tasks)]
+    for label, bench in (('Pool + Manager', bench_pool_manager), ('SyncExecutor', bench_executor)):
+        elapsed, count = bench(names, io_time)
+        print('{:<16} {} tasks, {} workers: {:.3f}s ({} shared entries)'.format(label, tasks, WORKERS, elapsed, count))
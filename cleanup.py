@@ -0,0 +1,137 @@
+# -*- coding:utf-8 -*-
+
+"""
+清理hub中已失效的实体：upsource中已删除的项目、gitlab中已删除分组对应的team，以及team与项目的关联
+先删除依赖方(关联)，再删除项目和team；依赖的删除失败时跳过
+"""
+
+import collections
+from executor import SyncExecutor
+
+LINK = 'link'
+PROJECT = 'project'
+GROUP = 'group'
+#: 删除顺序，依赖方在前
+STAGES = (LINK, PROJECT, GROUP)
+
+TEAM_SUFFIX = '-team'
+GLOBAL_PROJECT_ID = '0'
+
+#: kind: link、project或group；id: link为(用户组id, 项目角色id)；depends: 需要先删除的(kind, id)
+Deletion = collections.namedtuple('Deletion', ['kind', 'id', 'label', 'depends'])
+
+def hub_project_key(upsource_project_name):
+    """
+    upsource项目对应的hub项目key，与同步脚本创建项目时一致
+    :param upsource_project_name:
+    :return:
+    """
+    return upsource_project_name.replace('/', '-').replace('.', '-')
+
+def key_group(project_key, groups):
+    """
+    按同步脚本的<分组>-<项目>命名规则，取项目key所属的分组
+    :param project_key: hub项目key
+    :param groups: 分组集合
+    :return: 分组，不符合命名规则时返回None
+    """
+    index = project_key.find('-')
+    while index > 0:
+        if project_key[:index] in groups:
+            return project_key[:index]
+        index = project_key.find('-', index + 1)
+    return None
+
+def find_stale_entities(hub_client, upsource_project_names, gitlab_groups, keep_groups=(), max_workers=8):
+    """
+    对比hub、upsource和gitlab，找出需要删除的实体
+    项目: key符合同步脚本的<分组>-<项目>命名，不对应任何upsource项目，且已没有关联的资源(upsource删除项目时会删除资源)
+    team: 名称为<分组>-team，且gitlab中已没有该分组
+    关联: 属于待删除的team或项目；手工授予其它项目的角色保留
+    :param hub_client:
+    :param upsource_project_names: upsource中所有项目名称
+    :param gitlab_groups: gitlab中的分组
+    :param keep_groups: 不同步的分组，对应的team和项目保留
+    :param max_workers: 并发请求数
+    :return: ([Deletion], [(team, error)])，读取关联失败的team不删除
+    """
+    upsource_keys = set(hub_project_key(name) for name in upsource_project_names)
+    keep_groups = set(keep_groups)
+    gitlab_groups = set(gitlab_groups) | keep_groups
+
+    teams = [g for g in hub_client.get_all_user_groups(fields='id,name') if g['name'].endswith(TEAM_SUFFIX)]
+    stale_groups = {g['id']: g for g in teams if g['name'][:-len(TEAM_SUFFIX)] not in gitlab_groups}
+
+    # 同步脚本创建的项目属于gitlab分组或已有team对应的分组
+    sync_groups = (gitlab_groups | set(g['name'][:-len(TEAM_SUFFIX)] for g in teams)) - keep_groups
+    stale_projects = {}
+    for p in hub_client.get_all_projects(fields='id,key,name,resources(id)'):
+        if (p['id'] != GLOBAL_PROJECT_ID and p['key'] not in upsource_keys and not p.get('resources')
+                and key_group(p['key'], sync_groups) is not None):
+            stale_projects[p['id']] = p
+
+    # 并发读取每个team的项目角色
+    results = SyncExecutor(max_workers).run(
+        lambda team: list(hub_client.get_project_roles_of_usergroup(team['id'], fields='id,project(id,key)')), teams)
+
+    deletions = []
+    depends = collections.defaultdict(list)
+    scan_errors = []
+    for r in results:
+        team = r.item
+        if r.error is not None:
+            scan_errors.append((team['name'], r.error))
+            stale_groups.pop(team['id'], None)
+            continue
+        for role in r.value:
+            project = role.get('project') or {}
+            if not (team['id'] in stale_groups or project.get('id') in stale_projects):
+                continue
+            link = Deletion(LINK, (team['id'], role['id']), '{} -> {}'.format(team['name'], project.get('key')), ())
+            deletions.append(link)
+            depends[(GROUP, team['id'])].append((LINK, link.id))
+            depends[(PROJECT, project.get('id'))].append((LINK, link.id))
+
+    for project_id, p in stale_projects.items():
+        deletions.append(Deletion(PROJECT, project_id, p['key'], tuple(depends[(PROJECT, project_id)])))
+    for group_id, g in stale_groups.items():
+        deletions.append(Deletion(GROUP, group_id, g['name'], tuple(depends[(GROUP, group_id)])))
+    return deletions, scan_errors
+
+def execute_deletions(hub_client, deletions, max_workers=8, dry_run=True):
+    """
+    按STAGES顺序删除，同一阶段内并发执行；依赖的删除失败或被跳过时跳过
+    :param hub_client:
+    :param deletions: [Deletion]
+    :param max_workers: 并发请求数
+    :param dry_run: 为True时不删除，只返回计划
+    :return: {'deleted': [Deletion], 'failed': [(Deletion, error)], 'skipped': [Deletion]}
+    """
+    operations = {
+        LINK: lambda d: hub_client.delete_project_role_from_project_roles_of_usergroup(*d.id),
+        PROJECT: lambda d: hub_client.delete_project(d.id),
+        GROUP: lambda d: hub_client.delete_user_group(d.id),
+    }
+    report = {'deleted': [], 'failed': [], 'skipped': []}
+    not_deleted = set()
+    executor = SyncExecutor(max_workers)
+    for stage in STAGES:
+        ready = []
+        for d in deletions:
+            if d.kind != stage:
+                continue
+            if any(dep in not_deleted for dep in d.depends):
+                report['skipped'].append(d)
+                not_deleted.add((d.kind, d.id))
+            else:
+                ready.append(d)
+        if dry_run:
+            report['deleted'].extend(ready)
+            continue
+        for r in executor.run(operations[stage], ready):
+            if r.error is None:
+                report['deleted'].append(r.item)
+            else:
+                report['failed'].append((r.item, r.error))
+                not_deleted.add((r.item.kind, r.item.id))
+    return report
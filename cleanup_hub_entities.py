@@ -0,0 +1,100 @@
+# -*- coding:utf-8 -*-
+
+"""
+此脚本用于清理hub中已失效的项目、team和team与项目的关联
+默认只输出计划，--apply时执行
+"""
+
+import sys
+import argparse
+import datetime
+from upsource_hub_api.HubClient import HubClient
+from upsource_hub_api.UpsourceClient import UpsourceClient
+from upsource_hub_api.deadline import Deadline
+from upsource_hub_api.gitlab_snapshot import GitlabSnapshot, add_max_age_argument
+from upsource_hub_api.cleanup import STAGES, find_stale_entities, execute_deletions
+from upsource_hub_api.token_auth import auth_from_config
+from upsource_hub_api.config import load_config, add_config_argument
+
+def add_arguments(parser):
+    """
+    添加命令行参数
+    :param parser:
+    :return:
+    """
+    parser.add_argument('--deadline-hours', type=float, default=2, help='deadline for the whole run, in hours')
+    parser.add_argument('--snapshot', help='GitLab snapshot written by gitlab_snapshot.py, used instead of crawling GitLab')
+    add_max_age_argument(parser)
+    parser.add_argument('--processes', type=int, default=8, help='concurrent Hub requests')
+    parser.add_argument('--apply', action='store_true', help='delete the stale entities (default: only print the plan)')
+
+def main(config, args):
+    """
+    清理hub中已失效的实体
+    :param config: config.load_config()的返回值
+    :param args: 命令行参数
+    :return:
+    """
+    today = datetime.datetime.now().strftime('%Y-%m-%d')
+    print("Today: " + today)
+
+    # 整体运行截止时间，单次请求的超时时间不超过剩余时间
+    run_deadline = Deadline(args.deadline_hours * 3600)
+
+    # 连接hub
+    hub_config = config['hub']
+    hub_client = HubClient(hub_config['url'], hub_config['username'], hub_config['password'], deadline=run_deadline, hedge=True, token=auth_from_config(config, 'hub'))
+    print('{} connect successful.'.format(hub_client))
+
+    # 连接upsource
+    upsource_config = config['upsource']
+    upsource_client = UpsourceClient(upsource_config['url'], upsource_config['username'], upsource_config['password'], deadline=run_deadline, hedge=True, token=auth_from_config(config, 'upsource'))
+    print('{} connect successful.'.format(upsource_client))
+
+    group_ignore_list = ['Component']
+    if args.snapshot:
+        gitlab_groups = GitlabSnapshot.load(args.snapshot, max_age=args.max_snapshot_age * 3600).groups
+    else:
+        from gitlab_api.base import gitlabapi
+
+        # 连接gitlab
+        try:
+            gitlab_client = gitlabapi(**config['gitlab'])
+            print("Connect Gitlab Successful")
+        except Exception as e:
+            print("Connect Gitlab Failed: " + str(e))
+            sys.exit(1)
+        gitlab_groups = list(gitlab_client.groups().keys())
+    gitlab_groups = set(gitlab_groups)
+
+    upsource_projects_name = upsource_client.get_all_project_names()
+    if not upsource_projects_name or not gitlab_groups:
+        # 列表为空通常是接口异常，此时所有实体都会被判定为失效
+        print('Empty Upsource project list or GitLab group list, nothing is deleted')
+        sys.exit(1)
+
+    deletions, scan_errors = find_stale_entities(hub_client, upsource_projects_name, gitlab_groups, keep_groups=group_ignore_list, max_workers=args.processes)
+    for team, err in scan_errors:
+        print('Failed to list project roles of {}, skipped: {}'.format(team, err))
+    for stage in STAGES:
+        for d in deletions:
+            if d.kind == stage:
+                print('stale {} {}'.format(d.kind, d.label))
+
+    report = execute_deletions(hub_client, deletions, max_workers=args.processes, dry_run=not args.apply)
+    if not args.apply:
+        print('{} stale entities, dry run, use --apply to delete'.format(len(deletions)))
+        return
+
+    for d, err in report['failed']:
+        print('Failed to delete {} {}: {}'.format(d.kind, d.label, err))
+    for d in report['skipped']:
+        print('Skip {} {}: a dependency was not deleted'.format(d.kind, d.label))
+    print('Deleted: {}, failed: {}, skipped: {}'.format(len(report['deleted']), len(report['failed']), len(report['skipped'])))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Delete Hub projects, teams and team-project links whose Upsource/GitLab counterpart is gone')
+    add_config_argument(parser)
+    add_arguments(parser)
+    args = parser.parse_args()
+    main(load_config(args.config), args)
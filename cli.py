@@ -0,0 +1,68 @@
+# -*- coding:utf-8 -*-
+
+"""
+upsource-hub命令行入口，子命令对应各同步脚本
+脚本模块(以及requests、pymysql、gitlab_api等依赖)只在执行对应子命令时才导入
+用法: python cli.py [--config 配置文件] <子命令> [参数]
+"""
+
+import os
+import sys
+import argparse
+import importlib
+
+# 脚本与本文件位于同一目录
+SCRIPT_PATH = os.path.split(os.path.realpath(__file__))[0]
+
+#: 子命令: (名称, 脚本模块, 说明, 固定参数)
+COMMANDS = [
+    ('sync-teams', 'hub_projects_and_team_permission', 'Sync Hub teams with GitLab groups', {'phase': 'team'}),
+    ('sync-projects', 'hub_projects_and_team_permission', 'Sync Hub project permissions with GitLab projects', {'phase': 'project'}),
+    ('sync-users', 'update_hub_users', 'Sync active GitLab users to Hub', {}),
+    ('create-projects', 'upsource_create_project', 'Create Upsource projects for active GitLab projects', {}),
+    ('reindex', 'upsource_reindex_projects', 'Reset Upsource projects for re-indexing, a few at a time', {}),
+    ('reconcile-settings', 'upsource_reconcile_settings', 'Reconcile Upsource project settings', {}),
+    ('merge-users', 'merge_hub_users', 'Merge duplicate Hub accounts and invite new users', {}),
+    ('cleanup', 'cleanup_hub_entities', 'Delete stale Hub projects, teams and team-project links', {}),
+    ('webhooks', 'update_gitlab_webhook', 'Create missing Upsource and Jenkins webhooks in GitLab', {}),
+    ('snapshot', 'gitlab_snapshot', 'Crawl GitLab once and write a snapshot', {}),
+]
+
+def import_script(module_name):
+    """
+    导入脚本模块
+    :param module_name:
+    :return:
+    """
+    if SCRIPT_PATH not in sys.path:
+        sys.path.insert(0, SCRIPT_PATH)
+    return importlib.import_module(module_name)
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='upsource-hub', description='Upsource/Hub/GitLab synchronization')
+    parser.add_argument('--config', help='JSON config file with hub/upsource/gitlab/jenkins/dingtalk_db sections '
+                                         '(default: $UPSOURCE_HUB_CONFIG)')
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    subparsers.required = True
+    for name, module_name, help_text, _ in COMMANDS:
+        # 子命令的参数由脚本的add_arguments定义，选定子命令后再导入脚本解析
+        subparsers.add_parser(name, help=help_text, add_help=False)
+    return parser
+
+def main(argv=None):
+    args, script_argv = build_parser().parse_known_args(argv)
+    _, module_name, help_text, defaults = [c for c in COMMANDS if c[0] == args.command][0]
+
+    # 只导入所选子命令的脚本
+    from upsource_hub_api.config import load_config, add_config_argument
+    module = import_script(module_name)
+    script_parser = argparse.ArgumentParser(prog='upsource-hub {}'.format(args.command), description=help_text)
+    add_config_argument(script_parser)
+    module.add_arguments(script_parser)
+    script_args = script_parser.parse_args(script_argv)
+    for key, value in defaults.items():
+        setattr(script_args, key, value)
+    return module.main(load_config(script_args.config or args.config), script_args)
+
+if __name__ == '__main__':
+    main()
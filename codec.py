@@ -0,0 +1,135 @@
+# -*- coding:utf-8 -*-
+
+"""
+HubClient和UpsourceClient使用的JSON编解码，优先使用已安装的高性能JSON库，
+依次尝试orjson、ujson、simplejson，都未安装时使用标准库json
+可通过UPSOURCE_HUB_JSON环境变量或set_codec()指定
+"""
+
+import os
+import json
+
+class Codec:
+    """
+    JSON编解码实现
+    name: 库名称
+    dumps: 对象编码为UTF-8字节串
+    loads: 字节串或字符串解码为对象
+    """
+    def __init__(self, name, dumps, loads):
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+
+    def __repr__(self):
+        return 'Codec({})'.format(self.name)
+
+    def dumps_str(self, obj):
+        """
+        编码为字符串，用于请求参数
+        :param obj:
+        :return:
+        """
+        return self.dumps(obj).decode('utf-8')
+
+def _stdlib_codec(module, name):
+    def dumps(obj):
+        return module.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def loads(data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return module.loads(data)
+    return Codec(name, dumps, loads)
+
+def _orjson_codec():
+    import orjson
+    return Codec('orjson', orjson.dumps, orjson.loads)
+
+def _ujson_codec():
+    import ujson
+
+    def dumps(obj):
+        data = ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False)
+        # python2下ujson返回UTF-8编码的str，只有python3返回的字符串需要编码
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        return data
+    return Codec('ujson', dumps, ujson.loads)
+
+def _simplejson_codec():
+    import simplejson
+    return _stdlib_codec(simplejson, 'simplejson')
+
+def _json_codec():
+    return _stdlib_codec(json, 'json')
+
+#: 按优先级排列的编解码实现
+CODECS = [
+    ('orjson', _orjson_codec),
+    ('ujson', _ujson_codec),
+    ('simplejson', _simplejson_codec),
+    ('json', _json_codec),
+]
+
+def load_codec(name=None):
+    """
+    加载编解码实现
+    :param name: 库名称，为None时使用第一个可用的库
+    :return: Codec
+    """
+    factories = dict(CODECS)
+    if name is not None:
+        if name not in factories:
+            raise ValueError('Unknown JSON codec {}, expected one of {}'.format(name, ', '.join(n for n, _ in CODECS)))
+        return factories[name]()
+    for _, factory in CODECS:
+        try:
+            return factory()
+        except ImportError:
+            continue
+
+def available_codecs():
+    """
+    已安装的编解码实现
+    :return: [Codec]
+    """
+    codecs = []
+    for _, factory in CODECS:
+        try:
+            codecs.append(factory())
+        except ImportError:
+            continue
+    return codecs
+
+_codec = load_codec(os.environ.get('UPSOURCE_HUB_JSON') or None)
+
+def get_codec():
+    return _codec
+
+def set_codec(name):
+    """
+    切换全局使用的编解码实现
+    :param name: orjson、ujson、simplejson或json
+    :return: Codec
+    """
+    global _codec
+    _codec = load_codec(name)
+    return _codec
+
+def dumps(obj):
+    return _codec.dumps(obj)
+
+def dumps_str(obj):
+    return _codec.dumps_str(obj)
+
+def loads(data):
+    return _codec.loads(data)
+
+def response_json(response):
+    """
+    解码HTTP响应内容
+    :param response: requests的Response
+    :return:
+    """
+    return _codec.loads(response.content)
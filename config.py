@@ -0,0 +1,73 @@
+# -*- coding:utf-8 -*-
+
+"""
+同步脚本的连接配置，默认值可被JSON配置文件覆盖
+配置文件路径通过--config参数或UPSOURCE_HUB_CONFIG环境变量指定
+hub和upsource可选配置token(永久令牌)，或client_id、client_secret、scope(OAuth client credentials)，
+配置后不再使用用户名密码，见token_auth.auth_from_config
+http2: --http2时的传输层配置，prior_knowledge为True时明文http地址直接使用HTTP/2(h2c)
+"""
+
+import os
+import json
+import copy
+
+DEFAULT_CONFIG = {
+    'hub': {
+        'url': 'http://upsource.*.work/hub',
+        'username': '****',
+        'password': '****',
+    },
+    'upsource': {
+        'url': 'http://upsource.*.work',
+        'username': '****',
+        'password': '****',
+    },
+    'http2': {
+        'prior_knowledge': False,
+        'max_connections': 4,
+    },
+    'gitlab': {
+        'gitlab_url': 'http://git.*.work',
+        'email': '****',
+        'password': '****',
+    },
+    'jenkins': {
+        'jenkins_url': 'http://sonar.jenkins.*.work/',
+        'username': '****',
+        'password': '****',
+    },
+    'dingtalk_db': {
+        'host': '*.*.*.*',
+        'port': 3306,
+        'user': 'sonar',
+        'password': 'sonar',
+        'db': 'dingtalk_develop_members',
+        'charset': 'utf8mb4',
+    },
+}
+
+def _merge(base, override):
+    for key, value in override.items():
+        if isinstance(value, dict) and isinstance(base.get(key), dict):
+            _merge(base[key], value)
+        else:
+            base[key] = value
+    return base
+
+def load_config(path=None):
+    """
+    加载配置：默认配置与配置文件合并
+    :param path: JSON配置文件路径，默认读取UPSOURCE_HUB_CONFIG环境变量
+    :return:
+    """
+    config = copy.deepcopy(DEFAULT_CONFIG)
+    path = path or os.environ.get('UPSOURCE_HUB_CONFIG')
+    if path:
+        with open(path, 'r') as fp:
+            _merge(config, json.load(fp))
+    return config
+
+def add_config_argument(parser):
+    parser.add_argument('--config', help='JSON config file with hub/upsource/gitlab/jenkins/dingtalk_db sections '
+                                         '(default: $UPSOURCE_HUB_CONFIG)')
@@ -0,0 +1,146 @@
+# -*- coding:utf-8 -*-
+
+"""
+请求超时、整体运行截止时间和对冲请求(hedged request)
+"""
+
+import time
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+class DeadlineExceeded(Exception):
+    pass
+
+class Deadline:
+    """
+    整体运行截止时间，seconds为None时不限制
+    """
+    def __init__(self, seconds=None):
+        self.expires_at = time.time() + seconds if seconds is not None else None
+
+    def remaining(self):
+        """
+        剩余秒数，不限制时返回None
+        :return:
+        """
+        if self.expires_at is None:
+            return None
+        return max(0.0, self.expires_at - time.time())
+
+    def expired(self):
+        return self.expires_at is not None and time.time() >= self.expires_at
+
+    def timeout(self, timeout):
+        """
+        将单次请求的超时时间限制在剩余时间内
+        :param timeout: 秒数或(connect, read)元组
+        :return:
+        """
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        if remaining <= 0:
+            raise DeadlineExceeded('Run deadline exceeded')
+        if isinstance(timeout, tuple):
+            return tuple(min(t, remaining) for t in timeout)
+        return min(timeout, remaining) if timeout is not None else remaining
+
+class RequestMetrics:
+    """
+    请求统计：请求数、超时数、对冲请求数和最近的请求耗时
+    """
+    def __init__(self, window=500):
+        self.window = window
+        self.requests = 0
+        self.timeouts = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self._latencies = []
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def observe(self, seconds):
+        with self._lock:
+            self.requests += 1
+            self._latencies.append(seconds)
+            if len(self._latencies) > self.window:
+                del self._latencies[0]
+
+    def percentile(self, p, min_samples=20):
+        """
+        最近请求耗时的百分位数，样本不足时返回None
+        :param p: 0-100
+        :param min_samples:
+        :return:
+        """
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+    def summary(self):
+        return {
+            'requests': self.requests,
+            'timeouts': self.timeouts,
+            'hedged': self.hedged,
+            'hedge_wins': self.hedge_wins,
+            'p95': self.percentile(95),
+        }
+
+def hedged_call(fn, delay, metrics=None):
+    """
+    执行幂等请求fn，delay秒内未返回时再发起一次相同的请求，返回先成功的结果
+    :param fn: 无参数的请求函数
+    :param delay: 发起第二次请求前等待的秒数，None表示不对冲
+    :param metrics: RequestMetrics
+    :return:
+    """
+    if delay is None:
+        return fn()
+
+    results = queue.Queue()
+
+    def attempt(index):
+        try:
+            results.put((index, fn(), None))
+        except Exception as e:
+            results.put((index, None, e))
+
+    def start(index):
+        t = threading.Thread(target=attempt, args=(index,))
+        t.daemon = True
+        t.start()
+
+    start(0)
+    try:
+        index, value, err = results.get(timeout=delay)
+    except queue.Empty:
+        if metrics:
+            metrics.incr('hedged')
+        start(1)
+        index, value, err = results.get()
+        if err is not None:
+            # 第一个返回的请求失败时等待另一个请求
+            index, value, err = results.get()
+        if err is None and index == 1 and metrics:
+            metrics.incr('hedge_wins')
+    if err is not None:
+        raise err
+    return value
@@ -0,0 +1,94 @@
+# -*- coding:utf-8 -*-
+
+"""
+基于线程池的同步任务执行器，适用于以HTTP请求为主的I/O密集型任务
+"""
+
+import time
+import threading
+import traceback
+import collections
+from multiprocessing.pool import ThreadPool
+from deadline import DeadlineExceeded
+
+TaskResult = collections.namedtuple('TaskResult', ['item', 'value', 'error', 'traceback', 'elapsed'])
+
+class LockedDict(dict):
+    """
+    多线程共享的字典，写操作加锁；需要组合操作时使用with shared.lock
+    """
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.lock = threading.RLock()
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        with self.lock:
+            dict.__delitem__(self, key)
+
+    def setdefault(self, key, default=None):
+        with self.lock:
+            return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        with self.lock:
+            dict.update(self, *args, **kwargs)
+
+    def pop(self, key, *args):
+        with self.lock:
+            return dict.pop(self, key, *args)
+
+class SyncExecutor:
+    """
+    在线程池中执行任务，收集每个任务的返回值、异常和耗时
+    """
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+
+    @staticmethod
+    def _call(fn, item, args, kwargs):
+        started = time.time()
+        try:
+            value = fn(item, *args, **kwargs)
+            return TaskResult(item, value, None, None, time.time() - started)
+        except Exception as e:
+            return TaskResult(item, None, e, traceback.format_exc(), time.time() - started)
+
+    def run(self, fn, items, *args, **kwargs):
+        """
+        对每个item并发执行fn(item, *args, **kwargs)
+        :param fn:
+        :param items:
+        :return: 按items顺序返回的TaskResult列表
+        """
+        items = list(items)
+        if not items:
+            return []
+        pool = ThreadPool(min(self.max_workers, len(items)))
+        try:
+            return pool.map(lambda item: self._call(fn, item, args, kwargs), items)
+        finally:
+            pool.close()
+            pool.join()
+
+    @staticmethod
+    def report(phase, results):
+        """
+        输出执行结果统计和失败任务的异常，因运行截止时间未完成的任务只输出数量
+        :param phase: 阶段名称
+        :param results: TaskResult列表
+        :return: 失败的TaskResult列表
+        """
+        failed = [r for r in results if r.error is not None]
+        elapsed = sum(r.elapsed for r in results)
+        print('{}: {} tasks, {} failed, {:.1f}s task time'.format(phase, len(results), len(failed), elapsed))
+        unfinished = [r for r in failed if isinstance(r.error, DeadlineExceeded)]
+        if unfinished:
+            print('{}: {} tasks not finished before the run deadline'.format(phase, len(unfinished)))
+        for r in failed:
+            if not isinstance(r.error, DeadlineExceeded):
+                print('{} {} failed: {}'.format(phase, r.item, r.traceback))
+        return failed
@@ -0,0 +1,237 @@
+# -*- coding:utf-8 -*-
+
+"""
+GitLab数据快照：一次抓取分组、项目、成员、默认分支和活跃时间，
+写入紧凑的二进制文件(字符串只保存一次)，各同步脚本直接加载，不再重复抓取
+用法: python gitlab_snapshot.py [--config 配置文件] <快照文件>
+"""
+
+import os
+import sys
+import mmap
+import json
+import zlib
+import time
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MAGIC = b'UHSNAP'
+VERSION = 1
+CODEC_MSGPACK = b'm'
+CODEC_JSON = b'j'
+HEADER = struct.Struct('>6sB1s')
+
+class SnapshotError(Exception):
+    pass
+
+class GitlabSnapshot:
+    """
+    GitLab数据快照
+    groups: 分组列表
+    group_members: {分组: [用户名]}
+    project_members: {项目路径: [用户名]}
+    project_info: {项目路径: {'project_id', 'default_branch', 'last_activity_day', 'project_type'}}
+    """
+    def __init__(self, groups, group_members, project_members, project_info, created_at=None):
+        self.groups = groups
+        self.group_members = group_members
+        self.project_members = project_members
+        self.project_info = project_info
+        self.created_at = created_at or time.time()
+
+    def age(self):
+        """
+        快照已存在的秒数
+        :return:
+        """
+        return time.time() - self.created_at
+
+    def projects(self):
+        """
+        项目列表，格式与list_projects(simple=True)相同的id和path_with_namespace字段
+        :return:
+        """
+        return [{'id': info['project_id'], 'path_with_namespace': path} for path, info in self.project_info.items()]
+
+    def _encode(self):
+        strings = []
+        index = {}
+
+        def intern(value):
+            if value is None:
+                return -1
+            i = index.get(value)
+            if i is None:
+                i = index[value] = len(strings)
+                strings.append(value)
+            return i
+
+        groups = [intern(g) for g in self.groups]
+        group_members = [[intern(g), [intern(m) for m in members]] for g, members in self.group_members.items()]
+        paths = set(self.project_info) | set(self.project_members)
+        projects = []
+        for path in sorted(paths):
+            info = self.project_info.get(path, {})
+            members = self.project_members.get(path)
+            projects.append([
+                intern(path),
+                info.get('project_id', -1),
+                intern(info.get('default_branch')),
+                intern(info.get('last_activity_day')),
+                intern(info.get('project_type')),
+                [intern(m) for m in members] if members is not None else None,
+            ])
+        return {'created_at': self.created_at, 'strings': strings, 'groups': groups,
+                'group_members': group_members, 'projects': projects}
+
+    @classmethod
+    def _decode(cls, payload):
+        strings = payload['strings']
+
+        def lookup(i):
+            return strings[i] if i >= 0 else None
+
+        groups = [strings[i] for i in payload['groups']]
+        group_members = {strings[g]: [strings[m] for m in members] for g, members in payload['group_members']}
+        project_members = {}
+        project_info = {}
+        for path_i, project_id, branch_i, day_i, type_i, members in payload['projects']:
+            path = strings[path_i]
+            if project_id != -1:
+                project_info[path] = {
+                    'project_id': project_id,
+                    'default_branch': lookup(branch_i),
+                    'last_activity_day': lookup(day_i),
+                    'project_type': lookup(type_i),
+                }
+            if members is not None:
+                project_members[path] = [strings[m] for m in members]
+        return cls(groups, group_members, project_members, project_info, payload['created_at'])
+
+    def save(self, path):
+        """
+        写入快照文件，先写临时文件再替换，避免读取到不完整的快照
+        :param path:
+        :return:
+        """
+        payload = self._encode()
+        if msgpack is not None:
+            codec, body = CODEC_MSGPACK, msgpack.packb(payload, use_bin_type=True)
+        else:
+            codec, body = CODEC_JSON, zlib.compress(json.dumps(payload, separators=(',', ':')).encode('utf-8'))
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as fp:
+            fp.write(HEADER.pack(MAGIC, VERSION, codec))
+            fp.write(body)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, max_age=None):
+        """
+        读取快照文件，文件通过mmap映射，msgpack直接从映射的内存中解码
+        :param path:
+        :param max_age: 快照最长有效秒数，超过时抛出SnapshotError；None或0不检查
+        :return:
+        """
+        with open(path, 'rb') as fp:
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if len(mm) < HEADER.size:
+                    raise SnapshotError('{} is not a GitLab snapshot'.format(path))
+                magic, version, codec = HEADER.unpack(mm[:HEADER.size])
+                if magic != MAGIC:
+                    raise SnapshotError('{} is not a GitLab snapshot'.format(path))
+                if version != VERSION:
+                    raise SnapshotError('Unsupported snapshot version {} in {}'.format(version, path))
+                if codec == CODEC_MSGPACK:
+                    if msgpack is None:
+                        raise SnapshotError('msgpack is required to read {}'.format(path))
+                    try:
+                        body = memoryview(mm)[HEADER.size:]
+                    except TypeError:
+                        # python2的mmap不支持memoryview
+                        body = mm[HEADER.size:]
+                    payload = msgpack.unpackb(body, raw=False)
+                    # 关闭mmap前释放对映射内存的引用
+                    del body
+                else:
+                    payload = json.loads(zlib.decompress(mm[HEADER.size:]).decode('utf-8'))
+            finally:
+                mm.close()
+        snapshot = cls._decode(payload)
+        if max_age and snapshot.age() > max_age:
+            raise SnapshotError('Snapshot {} is {:.1f} hours old, older than the {:.1f} hour limit; '
+                                'run gitlab_snapshot.py again'.format(path, snapshot.age() / 3600, max_age / 3600.0))
+        return snapshot
+
+def crawl(gitlab_client, count_pages=20):
+    """
+    抓取GitLab所有分组的分组成员、项目成员和项目信息
+    :param gitlab_client:
+    :param count_pages: 每次抓取的页数
+    :return: GitlabSnapshot
+    """
+    from gitlab_utils import get_gitlab_group_members, get_gitlab_pages_project_info
+
+    groups = list(gitlab_client.groups().keys())
+    group_members = get_gitlab_group_members(gitlab_client)
+
+    project_members = {}
+    project_info = {}
+    start_page = 1
+    while True:
+        numbers, members, infos = get_gitlab_pages_project_info(gitlab_client, groups, start_page, start_page + count_pages, need_info="members,default_branch,last_activity_day,project_type")
+        project_members.update(members)
+        project_info.update(infos)
+        start_page += count_pages
+        if numbers != 20 * count_pages:
+            break
+    return GitlabSnapshot(groups, group_members, project_members, project_info)
+
+def add_max_age_argument(parser):
+    parser.add_argument('--max-snapshot-age', type=float, default=24,
+                        help='with --snapshot, refuse snapshots older than this many hours (0: no limit)')
+
+def add_arguments(parser):
+    """
+    添加命令行参数
+    :param parser:
+    :return:
+    """
+    parser.add_argument('snapshot', help='snapshot file to write')
+
+def main(config, args):
+    """
+    抓取GitLab数据并写入快照文件
+    :param config: config.load_config()的返回值
+    :param args: 命令行参数
+    :return:
+    """
+    from gitlab_api.base import gitlabapi
+
+    # 连接gitlab
+    try:
+        gitlab_client = gitlabapi(**config['gitlab'])
+        print("Connect Gitlab Successful")
+    except Exception as e:
+        print("Connect Gitlab Failed: " + str(e))
+        sys.exit(1)
+
+    started = time.time()
+    snapshot = crawl(gitlab_client)
+    snapshot.save(args.snapshot)
+    print('Write snapshot {}: {} groups, {} projects in {:.1f}s'.format(args.snapshot, len(snapshot.groups), len(snapshot.project_info), time.time() - started))
+
+if __name__ == '__main__':
+    import argparse
+    from upsource_hub_api.config import load_config, add_config_argument
+
+    parser = argparse.ArgumentParser(description='Crawl GitLab once and write a snapshot for the sync scripts')
+    add_config_argument(parser)
+    add_arguments(parser)
+    args = parser.parse_args()
+    main(load_config(args.config), args)
@@ -5,14 +5,32 @@
 """
 
 import sys
+import os
+import argparse
+from multiprocessing.pool import ThreadPool
 from upsource_hub_api.HubClient import HubClient
 from upsource_hub_api.UpsourceClient import UpsourceClient
-import multiprocessing
+from upsource_hub_api.deadline import Deadline
+from upsource_hub_api.executor import SyncExecutor, LockedDict
+from upsource_hub_api.job_queue import JobQueue
+from upsource_hub_api.gitlab_snapshot import GitlabSnapshot, add_max_age_argument
+from upsource_hub_api.profiler import PhaseProfiler
+from upsource_hub_api.transport import make_transport
+from upsource_hub_api.token_auth import auth_from_config
+from upsource_hub_api.config import load_config, add_config_argument
 from gitlab_utils import get_gitlab_group_members, get_gitlab_pages_project_info
 import datetime
 from gitlab_api.base import gitlabapi
 
-def operate_hub_team_permission(gitlab_group, hub_client, hub_users, user_groups, gitlab_group_members):
+class RoleChangeError(Exception):
+    """
+    项目权限变更部分失败，任务记为失败，下次运行时重试
+    """
+    def __init__(self, hub_project_key, failed):
+        Exception.__init__(self, '{} role changes failed in project {}: {}'.format(len(failed), hub_project_key, failed[0][1]))
+        self.failed = failed
+
+def operate_hub_team_permission(gitlab_group, hub_client, hub_users, user_groups, gitlab_group_members, membership=None):
     """
     处理hub team
     :param gitlab_group:
@@ -20,6 +38,7 @@ def operate_hub_team_permission(gitlab_group, hub_client, hub_users, user_groups
     :param hub_users:
     :param user_groups:
     :param gitlab_group_members:
+    :param membership: team成员索引(HubClient.build_membership_index)，未索引的team从hub读取成员
     :return:
     """
     team_name = gitlab_group + '-team'
@@ -46,8 +65,11 @@ def operate_hub_team_permission(gitlab_group, hub_client, hub_users, user_groups
 
     else:
         user_group_id = user_groups[team_name]
-        user_group_exist_users = hub_client.get_users_of_user_group(user_group_id, fields='login')
-        existing_users = [u['login'] for u in list(user_group_exist_users)]
+        if membership is not None and team_name in membership:
+            existing_users = membership.users_of(team_name)
+        else:
+            user_group_exist_users = hub_client.get_users_of_user_group(user_group_id, fields='login')
+            existing_users = [u['login'] for u in list(user_group_exist_users)]
 
         need_add_users_to_user_group = list(set(gitlab_group_members[gitlab_group]) - set(existing_users))
         need_delete_users_from_user_group =  list(set(existing_users) - set(gitlab_group_members[gitlab_group]))
@@ -65,7 +87,7 @@ def operate_hub_team_permission(gitlab_group, hub_client, hub_users, user_groups
                 hub_client.remove_user_from_users_of_user_group(user_group_id, user_id)
                 print('delete {} from {}'.format(m, team_name))
 
-def operate_hub_project_permission(upsource_project_name, hub_client, upsource_client, hub_projects, hub_users, resources, user_groups, develop_role, gitlab_group_members, gitlab_project_members):
+def operate_hub_project_permission(upsource_project_name, hub_client, upsource_client, hub_projects, hub_users, resources, user_groups, develop_role, gitlab_group_members, gitlab_project_members, role_pool=None):
     """
     处理hub project权限
     :param upsource_project_name:
@@ -78,6 +100,7 @@ def operate_hub_project_permission(upsource_project_name, hub_client, upsource_c
     :param develop_role:
     :param gitlab_group_members:
     :param gitlab_project_members:
+    :param role_pool: 各项目共用的权限变更线程池，限制upsource总的并发写入数
     :return:
     """
     hub_project_key = upsource_project_name.replace('/','-').replace('.','-')
@@ -111,11 +134,9 @@ def operate_hub_project_permission(upsource_project_name, hub_client, upsource_c
             need_add_users_to_hub_project = list(set(gitlab_project_members[upsource_project_name]) - set(gitlab_group_members[gitlab_group]))
 
             # 将用户添加到项目(project)权限中
-            for m in need_add_users_to_hub_project:
-                if m in hub_users:
-                    user_id = hub_users[m]
-                    upsource_client.add_user_to_project(hub_project_key, user_id)
-                    print('Add user {} to project {}'.format(m, hub_project_key))
+            user_logins = {hub_users[m]: m for m in need_add_users_to_hub_project if m in hub_users}
+            role_changes = [('add', hub_project_key, user_id, develop_role['key']) for user_id in user_logins]
+            report_role_changes(upsource_client.apply_user_role_changes(role_changes, pool=role_pool), hub_project_key, user_logins)
     else:
         hub_team = upsource_project_name.split('/')[0] + '-team'
         hub_project_id = hub_projects[hub_project_key]
@@ -148,74 +169,114 @@ def operate_hub_project_permission(upsource_project_name, hub_client, upsource_c
             need_add_users_to_hub_project = []
             need_delete_users_from_hub_project = hub_project_exits_developers
 
-        # 将用户添加到项目(project)权限中
-        for m in need_add_users_to_hub_project:
-            if m in hub_users:
-                user_id = hub_users[m]
-                upsource_client.add_user_to_project(hub_project_key, user_id)
-                print('Add user {} to project {}'.format(m, hub_project_key))
-        # 删除多余的用户
-        for m in need_delete_users_from_hub_project:
-            if m in hub_users:
-                user_id = hub_users[m]
-                upsource_client.delete_user_from_project(hub_project_key, user_id)
-                print('delete {} from {}'.format(m, hub_project_key))
+        # 将用户添加到项目(project)权限中，并删除多余的用户
+        user_logins = {hub_users[m]: m for m in need_add_users_to_hub_project + need_delete_users_from_hub_project if m in hub_users}
+        role_changes = [('add', hub_project_key, hub_users[m], develop_role['key']) for m in need_add_users_to_hub_project if m in hub_users]
+        role_changes += [('delete', hub_project_key, hub_users[m], develop_role['key']) for m in need_delete_users_from_hub_project if m in hub_users]
+        report_role_changes(upsource_client.apply_user_role_changes(role_changes, pool=role_pool), hub_project_key, user_logins)
 
-if __name__ == '__main__':
+def report_role_changes(report, hub_project_key, user_logins):
+    """
+    输出项目权限变更结果
+    :param report: apply_user_role_changes的返回值
+    :param hub_project_key:
+    :param user_logins: {user_id: login}
+    :return:
+    :raise RoleChangeError: 有变更失败时抛出，使任务记为失败
+    """
+    for action, _, user_id, role_key in report['succeeded']:
+        print('{} {} {} in project {}'.format(action, role_key, user_logins[user_id], hub_project_key))
+    for (action, _, user_id, role_key), err in report['failed']:
+        print('Failed to {} {} {} in project {}: {}'.format(action, role_key, user_logins[user_id], hub_project_key, err))
+    if report['failed']:
+        raise RoleChangeError(hub_project_key, report['failed'])
+
+def add_arguments(parser):
+    """
+    添加命令行参数
+    :param parser:
+    :return:
+    """
+    parser.add_argument('--deadline-hours', type=float, default=6, help='deadline for the whole run, in hours')
+    parser.add_argument('--state-db', default=os.path.join(os.path.split(os.path.realpath(__file__))[0], 'hub_sync_state.db'),
+                        help='SQLite file recording team/project task state, used to resume interrupted runs')
+    parser.add_argument('--max-retries', type=int, default=3, help='failures before a task is moved to the dead-letter list')
+    parser.add_argument('--snapshot', help='GitLab snapshot written by gitlab_snapshot.py, used instead of crawling GitLab')
+    add_max_age_argument(parser)
+    parser.add_argument('--phase', choices=['all', 'team', 'project'], default='all', help='sync phase to run')
+    parser.add_argument('--profile', metavar='REPORT', help='record wall time, request counts and peak memory of each phase into a JSON report')
+    parser.add_argument('--http2', action='store_true', help='send Hub and Upsource requests over shared HTTP/2 connections (requires httpx[http2])')
+    parser.add_argument('--h2c', action='store_true', help='with --http2, use HTTP/2 without negotiation on http:// URLs (default: http2.prior_knowledge in config)')
+    parser.add_argument('--profile-dir', help='with --profile, also write a cProfile dump of each phase into this directory')
+
+def main(config, args):
+    """
+    同步hub team和project权限
+    :param config: config.load_config()的返回值
+    :param args: 命令行参数
+    :return:
+    """
     today = datetime.datetime.now().strftime('%Y-%m-%d')
     print("Today: " + today)
 
-    # hub账号信息
-    hub_config = {
-        'hub_url': 'http://upsource.*.work/hub',
-        'hub_username': "****",
-        'hub_password': "****"
-    }
+    # 整体运行截止时间，单次请求的超时时间不超过剩余时间
+    run_deadline = Deadline(args.deadline_hours * 3600)
+
+    # hub和upsource在同一反向代理后，--http2时两个客户端共用HTTP/2连接
+    # httpx不会把明文http连接升级为HTTP/2，http地址需要--h2c或配置http2.prior_knowledge
+    http2_config = config['http2']
+    transport = make_transport(http2=args.http2, max_connections=http2_config['max_connections'],
+                               prior_knowledge=args.h2c or http2_config['prior_knowledge'],
+                               urls=[config['hub']['url'], config['upsource']['url']])
+
     # 连接hub
-    hub_client = HubClient(hub_config['hub_url'], hub_config['hub_username'], hub_config['hub_password'])
+    hub_config = config['hub']
+    hub_client = HubClient(hub_config['url'], hub_config['username'], hub_config['password'], deadline=run_deadline, hedge=True, transport=transport, token=auth_from_config(config, 'hub'))
     print('{} connect successful.'.format(hub_client))
 
-    # upsource账号信息
-    upsource_config = {
-        'upsource_url': 'http://upsource.*.work',
-        'upsource_username': "****",
-        'upsource_password': "****"
-    }
     # 连接upsource
-    upsource_client = UpsourceClient(upsource_config['upsource_url'], upsource_config['upsource_username'], upsource_config['upsource_password'])
+    upsource_config = config['upsource']
+    upsource_client = UpsourceClient(upsource_config['url'], upsource_config['username'], upsource_config['password'], deadline=run_deadline, hedge=True, transport=transport, token=auth_from_config(config, 'upsource'))
     print('{} connect successful.'.format(upsource_client))
 
-    # gitlab账号信息
-    gitlab_config = {
-        "gitlab_url": "http://git.*.work",
-        "email": "****",
-        "password": "****"
-    }
-    # 连接gitlab
-    try:
-        gitlab_client = gitlabapi(**gitlab_config)
-        print("Connect Gitlab Successful")
-    except Exception as e:
-        print("Connect Gitlab Failed: " + str(e))
-        sys.exit(1)
-
-    # 获取gitlab groups
+    # --profile时记录每个阶段的耗时、请求数和内存峰值
+    profiler = PhaseProfiler({'hub': hub_client, 'upsource': upsource_client}, profile_dir=args.profile_dir, enabled=bool(args.profile))
+
     group_ignore_list = ['Component']
-    all_gitlab_groups = list(set(gitlab_client.groups().keys()) - set(group_ignore_list))
-
-    # 获取gitlab组成员
-    gitlab_group_members = get_gitlab_group_members(gitlab_client)
-
-    # 获取项目成员
-    count_pages = 20
-    start_page = 1
-    gitlab_project_members = {}
-    while True:
-        numbers, results, _ = get_gitlab_pages_project_info(gitlab_client, all_gitlab_groups, start_page, start_page + count_pages, need_info="members")
-        gitlab_project_members.update(results)
-        start_page += count_pages
-        if numbers != 20 * count_pages:
-            break
+    if args.snapshot:
+        # 从快照中加载gitlab分组、成员信息
+        with profiler.phase('gitlab_snapshot'):
+            snapshot = GitlabSnapshot.load(args.snapshot, max_age=args.max_snapshot_age * 3600)
+            all_gitlab_groups = list(set(snapshot.groups) - set(group_ignore_list))
+            gitlab_groups = set(all_gitlab_groups)
+            gitlab_group_members = snapshot.group_members
+            gitlab_project_members = {p: m for p, m in snapshot.project_members.items() if p.split('/')[0] in gitlab_groups}
+    else:
+        # 连接gitlab
+        try:
+            gitlab_client = gitlabapi(**config['gitlab'])
+            print("Connect Gitlab Successful")
+        except Exception as e:
+            print("Connect Gitlab Failed: " + str(e))
+            sys.exit(1)
+
+        with profiler.phase('gitlab_crawl'):
+            # 获取gitlab groups
+            all_gitlab_groups = list(set(gitlab_client.groups().keys()) - set(group_ignore_list))
+
+            # 获取gitlab组成员
+            gitlab_group_members = get_gitlab_group_members(gitlab_client)
+
+            # 获取项目成员
+            count_pages = 20
+            start_page = 1
+            gitlab_project_members = {}
+            while True:
+                numbers, results, _ = get_gitlab_pages_project_info(gitlab_client, all_gitlab_groups, start_page, start_page + count_pages, need_info="members")
+                gitlab_project_members.update(results)
+                start_page += count_pages
+                if numbers != 20 * count_pages:
+                    break
 
     develop_role = {
         'id': 'b72ba599-4e78-4714-abae-f50bdbb7fd3a',
@@ -224,45 +285,88 @@ if __name__ == '__main__':
     }
 
     # 获取hub用户组信息
-    user_groups_info = hub_client.get_all_user_groups(fields = 'name,id')
-    user_groups = {u['name']: u['id'] for u in list(user_groups_info)}
+    with profiler.phase('get_all_user_groups'):
+        user_groups_info = hub_client.get_all_user_groups(fields = 'name,id')
+        user_groups = {u['name']: u['id'] for u in list(user_groups_info)}
 
     # 获取hub用户信息
-    all_users_info = hub_client.get_all_users(fields='login,id')
-    hub_users = {u['login']: u['id'] for u in list(all_users_info)}
+    with profiler.phase('get_all_users'):
+        all_users_info = hub_client.get_all_users(fields='login,id')
+        hub_users = {u['login']: u['id'] for u in list(all_users_info)}
 
     # 获取upsource上所有的项目名称
-    upsource_projects_name = upsource_client.get_all_project_names()
+    with profiler.phase('get_all_project_names'):
+        upsource_projects_name = upsource_client.get_all_project_names()
 
     # 获取hub上所有的项目key
-    hub_projects_info = hub_client.get_all_projects(fields = 'id,key')
-    hub_projects = {hp['key']:hp['id'] for hp in list(hub_projects_info)}
-
-    resources_info = hub_client.get_all_resources(fields = 'id,key,name')
-    resources = {}
-    for r in list(resources_info):
-        resources[r['key']] = {
-            'id': r['id'],
-            'key': r['key'],
-            'name': r['name']
-    }
+    with profiler.phase('get_all_projects'):
+        hub_projects_info = hub_client.get_all_projects(fields = 'id,key')
+        hub_projects = {hp['key']:hp['id'] for hp in list(hub_projects_info)}
+
+    with profiler.phase('get_all_resources'):
+        resources_info = hub_client.get_all_resources(fields = 'id,key,name')
+        resources = {}
+        for r in list(resources_info):
+            resources[r['key']] = {
+                'id': r['id'],
+                'key': r['key'],
+                'name': r['name']
+        }
 
-    # 用户更新共享数据
-    user_groups_dict = multiprocessing.Manager().dict()
-    for key, vaule in user_groups.items():
-        user_groups_dict[key] = vaule
-
-    # 使用多进程处理hub team权限分配
-    pool1 = multiprocessing.Pool(4)
-    for p in range(len(all_gitlab_groups)):
-        pool1.apply_async(operate_hub_team_permission, args=(all_gitlab_groups[p], hub_client, hub_users, user_groups_dict, gitlab_group_members, ))
-    pool1.close()
-    pool1.join()
-
-    # 使用多进程处理hub project权限分配
-    pool2 = multiprocessing.Pool(4)
-    for p in range(len(upsource_projects_name)):
-        pool2.apply_async(operate_hub_project_permission, args=(upsource_projects_name[p], hub_client, upsource_client, hub_projects, hub_users, resources, user_groups_dict, develop_role, gitlab_group_members, gitlab_project_members, ))
-    pool2.close()
-    pool2.join()
+    # 用户组共享数据，在线程之间共享
+    user_groups_dict = LockedDict(user_groups)
+    executor = SyncExecutor(max_workers=8)
+
+    phases = ('team', 'project') if args.phase == 'all' else (args.phase,)
+
+    # 任务状态持久化，上次运行中断时只处理未完成和失败的任务
+    job_queue = JobQueue(args.state_db, max_retries=args.max_retries)
+    tasks = {'team': all_gitlab_groups, 'project': upsource_projects_name}
+    for kind in phases:
+        if job_queue.start_run(kind, tasks[kind]):
+            print('Resume {} tasks: {}'.format(kind, job_queue.summary(kind)))
+
+    # 并发处理hub team权限分配
+    if 'team' in phases:
+        # 一次并发读取待处理team的成员，建立成员索引
+        with profiler.phase('membership_index'):
+            pending_teams = [g + '-team' for g in job_queue.pending('team')]
+            membership = hub_client.build_membership_index([{'id': user_groups[t], 'name': t} for t in pending_teams if t in user_groups])
+        print('Membership index: {}'.format(membership.summary()))
+        for team_name, error in membership.failed:
+            print('Failed to index members of {}, reading them per team: {}'.format(team_name, error))
+
+        with profiler.phase('team'):
+            results = executor.run(job_queue.checkpointed('team', operate_hub_team_permission, run_deadline), job_queue.pending('team'), hub_client, hub_users, user_groups_dict, gitlab_group_members, membership)
+        executor.report('team', results)
+
+    # 并发处理hub project权限分配
+    if 'project' in phases:
+        # 所有项目共用一个权限变更线程池，upsource并发写入数不超过8
+        role_pool = ThreadPool(8)
+        try:
+            with profiler.phase('project'):
+                results = executor.run(job_queue.checkpointed('project', operate_hub_project_permission, run_deadline), job_queue.pending('project'), hub_client, upsource_client, hub_projects, hub_users, resources, user_groups_dict, develop_role, gitlab_group_members, gitlab_project_members, role_pool)
+        finally:
+            role_pool.close()
+            role_pool.join()
+        executor.report('project', results)
+
+    for kind in phases:
+        print('{} tasks: {}'.format(kind, job_queue.summary(kind)))
+        for key, retries, error in job_queue.dead_letters(kind):
+            print('Dead letter {} {} after {} attempts: {}'.format(kind, key, retries, error))
+    job_queue.close()
+
+    print('Hub requests: {}'.format(hub_client.metrics.summary()))
+    print('Upsource requests: {}'.format(upsource_client.metrics.summary()))
+    profiler.report(args.profile)
+    if transport is not None:
+        transport.close()
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sync Hub teams and project permissions with GitLab')
+    add_config_argument(parser)
+    add_arguments(parser)
+    args = parser.parse_args()
+    main(load_config(args.config), args)
@@ -0,0 +1,124 @@
+# -*- coding:utf-8 -*-
+
+"""
+基于SQLite的持久化任务队列，记录每个任务的状态，中断后再次运行时只处理未完成和失败的任务
+"""
+
+import time
+import sqlite3
+import threading
+from deadline import DeadlineExceeded
+
+PENDING = 'pending'
+DONE = 'done'
+FAILED = 'failed'
+DEAD = 'dead'
+
+class JobQueue:
+    """
+    任务按(kind, key)区分，状态为pending、done、failed或dead，
+    失败次数达到max_retries的任务进入dead-letter列表，不再重试
+    """
+    def __init__(self, path, max_retries=3):
+        self.path = path
+        self.max_retries = max_retries
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute('create table if not exists jobs ('
+                             'kind text not null, key text not null, status text not null, '
+                             'retries integer not null default 0, last_error text, updated_at real, '
+                             'primary key (kind, key))')
+
+    def close(self):
+        self._db.close()
+
+    def start_run(self, kind, keys):
+        """
+        开始处理一类任务：上次运行已全部完成时开始新一轮，否则继续上次的运行并加入新任务
+        :param kind: 任务类型，如'team'、'project'
+        :param keys: 本次运行的全部任务
+        :return: True表示继续上次中断的运行
+        """
+        now = time.time()
+        with self._lock, self._db:
+            unfinished = self._db.execute('select count(*) from jobs where kind = ? and status in (?, ?)',
+                                          (kind, PENDING, FAILED)).fetchone()[0]
+            if not unfinished:
+                self._db.execute('delete from jobs where kind = ?', (kind,))
+            self._db.executemany('insert or ignore into jobs (kind, key, status, updated_at) values (?, ?, ?, ?)',
+                                 [(kind, key, PENDING, now) for key in keys])
+        return bool(unfinished)
+
+    def pending(self, kind):
+        """
+        需要处理的任务(未处理或失败可重试)
+        :param kind:
+        :return:
+        """
+        with self._lock:
+            rows = self._db.execute('select key from jobs where kind = ? and status in (?, ?) order by rowid',
+                                    (kind, PENDING, FAILED)).fetchall()
+        return [row[0] for row in rows]
+
+    def mark_done(self, kind, key):
+        with self._lock, self._db:
+            self._db.execute('update jobs set status = ?, last_error = null, updated_at = ? where kind = ? and key = ?',
+                             (DONE, time.time(), kind, key))
+
+    def mark_failed(self, kind, key, error):
+        """
+        记录任务失败，失败次数达到max_retries后进入dead-letter
+        :param kind:
+        :param key:
+        :param error:
+        :return:
+        """
+        with self._lock, self._db:
+            self._db.execute('update jobs set retries = retries + 1, last_error = ?, updated_at = ?, '
+                             'status = case when retries + 1 >= ? then ? else ? end where kind = ? and key = ?',
+                             (str(error), time.time(), self.max_retries, DEAD, FAILED, kind, key))
+
+    def dead_letters(self, kind):
+        """
+        重试次数用尽的任务
+        :param kind:
+        :return: [(key, retries, last_error)]
+        """
+        with self._lock:
+            return self._db.execute('select key, retries, last_error from jobs where kind = ? and status = ? order by rowid',
+                                    (kind, DEAD)).fetchall()
+
+    def summary(self, kind):
+        """
+        各状态的任务数量
+        :param kind:
+        :return:
+        """
+        with self._lock:
+            rows = self._db.execute('select status, count(*) from jobs where kind = ? group by status', (kind,)).fetchall()
+        return dict(rows)
+
+    def checkpointed(self, kind, fn, deadline=None):
+        """
+        包装任务函数，每个任务完成后立即记录状态
+        运行截止时间已过时不再执行任务；因截止时间失败的任务保持原状态，不计入重试次数
+        :param kind:
+        :param fn: fn(key, *args, **kwargs)
+        :param deadline: 整体运行截止时间(deadline.Deadline)
+        :return:
+        """
+        def run(key, *args, **kwargs):
+            if deadline is not None and deadline.expired():
+                raise DeadlineExceeded('Run deadline exceeded, {} {} left for the next run'.format(kind, key))
+            try:
+                value = fn(key, *args, **kwargs)
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                if deadline is None or not deadline.expired():
+                    self.mark_failed(kind, key, e)
+                raise
+            self.mark_done(kind, key)
+            return value
+        return run
@@ -0,0 +1,101 @@
+# -*- coding:utf-8 -*-
+
+"""
+此脚本用于合并hub中邮箱相同的重复账号，并批量邀请尚未注册的用户
+默认只输出计划，--apply时执行
+"""
+
+import argparse
+import datetime
+from upsource_hub_api.HubClient import HubClient
+from upsource_hub_api.deadline import Deadline
+from upsource_hub_api.user_duplicates import index_users, find_duplicate_users, plan_user_merges
+from upsource_hub_api.token_auth import auth_from_config
+from upsource_hub_api.config import load_config, add_config_argument
+
+def load_invite_emails(path):
+    """
+    读取邀请邮箱文件，每行一个邮箱，忽略空行和#开头的行
+    :param path:
+    :return:
+    """
+    with open(path, 'r') as fp:
+        return [line.strip() for line in fp if line.strip() and not line.startswith('#')]
+
+def add_arguments(parser):
+    """
+    添加命令行参数
+    :param parser:
+    :return:
+    """
+    parser.add_argument('--deadline-hours', type=float, default=2, help='deadline for the whole run, in hours')
+    parser.add_argument('--invite', metavar='FILE', help='file with one email per line; emails without a Hub account are invited')
+    parser.add_argument('--processes', type=int, default=8, help='concurrent Hub requests')
+    parser.add_argument('--apply', action='store_true', help='execute the merges and invites (default: only print the plan)')
+
+def main(config, args):
+    """
+    合并重复账号，邀请新用户
+    :param config: config.load_config()的返回值
+    :param args: 命令行参数
+    :return:
+    """
+    today = datetime.datetime.now().strftime('%Y-%m-%d')
+    print("Today: " + today)
+
+    # 整体运行截止时间，单次请求的超时时间不超过剩余时间
+    run_deadline = Deadline(args.deadline_hours * 3600)
+
+    # 连接hub
+    hub_config = config['hub']
+    hub_client = HubClient(hub_config['url'], hub_config['username'], hub_config['password'], deadline=run_deadline, hedge=True, token=auth_from_config(config, 'hub'))
+    print('{} connect successful.'.format(hub_client))
+
+    # 一次遍历所有用户，按邮箱建立索引
+    email_index = index_users(hub_client.get_all_users(fields='id,login,banned,lastAccessTime,profile(email(email))'))
+    plan = plan_user_merges(find_duplicate_users(email_index))
+
+    merges = []
+    logins = {}
+    for email, target, sources in plan:
+        logins[target['id']] = target['login']
+        print('{}: keep {}, merge {}'.format(email, target['login'], ', '.join(u['login'] for u in sources)))
+        for source in sources:
+            logins[source['id']] = source['login']
+            merges.append((target['id'], source['id']))
+
+    invitations = []
+    if args.invite:
+        invited = set()
+        for email in load_invite_emails(args.invite):
+            key = email.lower()
+            if key not in email_index and key not in invited:
+                invited.add(key)
+                invitations.append(email)
+        for email in invitations:
+            print('invite {}'.format(email))
+
+    print('{} duplicate emails, {} accounts to merge, {} users to invite'.format(len(plan), len(merges), len(invitations)))
+    if not args.apply:
+        print('Dry run, use --apply to execute')
+        return
+
+    report = hub_client.merge_users_batch(merges, processes=args.processes)
+    for target, source in report['succeeded']:
+        print('merge {} into {}'.format(logins[source], logins[target]))
+    for (target, source), err in report['failed']:
+        print('Failed to merge {} into {}: {}'.format(logins[source], logins[target], err))
+
+    invite_report = hub_client.invite_users(invitations, processes=args.processes)
+    for invitation, err in invite_report['failed']:
+        print('Failed to invite {}: {}'.format(invitation['email'], err))
+
+    print('Merged: {}, merge failed: {}, invited: {}, invite failed: {}'.format(
+        len(report['succeeded']), len(report['failed']), len(invite_report['succeeded']), len(invite_report['failed'])))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge duplicate Hub accounts and invite new users')
+    add_config_argument(parser)
+    add_arguments(parser)
+    args = parser.parse_args()
+    main(load_config(args.config), args)
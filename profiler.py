@@ -0,0 +1,114 @@
+# -*- coding:utf-8 -*-
+
+"""
+同步脚本的分阶段性能分析：记录每个阶段的耗时、请求数、内存峰值，可选输出cProfile数据
+"""
+
+import os
+import time
+import json
+import cProfile
+import contextlib
+
+try:
+    import tracemalloc
+except ImportError:
+    # python2没有tracemalloc，不记录内存峰值
+    tracemalloc = None
+
+class PhaseProfiler:
+    """
+    分阶段性能分析
+    clients: {名称: 带metrics属性的客户端}，用于统计每个阶段的请求数
+    profile_dir: 每个阶段的cProfile数据输出目录，为None时不启用cProfile；
+    cProfile只分析调用phase的线程，线程池中执行的任务只体现为等待时间
+    阶段嵌套时内存峰值由最外层阶段开始统计
+    enabled为False时phase不做任何记录
+    """
+    def __init__(self, clients=None, profile_dir=None, enabled=True):
+        self.clients = clients or {}
+        self.profile_dir = profile_dir
+        self.enabled = enabled
+        self.phases = []
+        if enabled and profile_dir and not os.path.isdir(profile_dir):
+            os.makedirs(profile_dir)
+
+    def _request_counts(self):
+        counts = {}
+        for name, client in self.clients.items():
+            metrics = client.metrics
+            counts[name] = {'requests': metrics.requests, 'timeouts': metrics.timeouts, 'hedged': metrics.hedged}
+        return counts
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        记录一个阶段
+        :param name: 阶段名称
+        :return:
+        """
+        if not self.enabled:
+            yield
+            return
+
+        before = self._request_counts()
+        tracing = tracemalloc is not None and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        profile = cProfile.Profile() if self.profile_dir else None
+        started = time.time()
+        error = None
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        except Exception as e:
+            error = '{}: {}'.format(type(e).__name__, e)
+            raise
+        finally:
+            if profile is not None:
+                profile.disable()
+            elapsed = time.time() - started
+
+            peak = None
+            if tracemalloc is not None:
+                peak = tracemalloc.get_traced_memory()[1]
+                if tracing:
+                    tracemalloc.stop()
+
+            after = self._request_counts()
+            requests = {}
+            for client_name, counts in after.items():
+                requests[client_name] = {k: v - before[client_name][k] for k, v in counts.items()}
+
+            profile_path = None
+            if profile is not None:
+                profile_path = os.path.join(self.profile_dir, '{}.prof'.format(name.replace('/', '_')))
+                profile.dump_stats(profile_path)
+
+            self.phases.append({
+                'phase': name,
+                'wall_time': round(elapsed, 3),
+                'requests': requests,
+                'peak_memory': peak,
+                'profile': profile_path,
+                'error': error,
+            })
+
+    def report(self, path=None):
+        """
+        输出所有阶段的统计，path不为空时同时写入JSON文件
+        :param path:
+        :return:
+        """
+        if not self.enabled:
+            return
+        for p in self.phases:
+            requests = ', '.join('{} {}'.format(name, counts['requests']) for name, counts in sorted(p['requests'].items()))
+            peak = '{:.1f}MB'.format(p['peak_memory'] / 1024.0 / 1024) if p['peak_memory'] is not None else '-'
+            print('Phase {:<24} {:>9.2f}s  requests: {}  peak memory: {}{}'.format(
+                p['phase'], p['wall_time'], requests or '-', peak, '  FAILED' if p['error'] else ''))
+        if path:
+            with open(path, 'w') as fp:
+                json.dump({'created_at': time.time(), 'phases': self.phases}, fp, indent=2, sort_keys=True)
+            print('Write profile report {}'.format(path))
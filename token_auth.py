@@ -0,0 +1,214 @@
+# -*- coding:utf-8 -*-
+
+"""
+Hub令牌认证：永久令牌(permanent token)或OAuth client credentials获取的访问令牌
+访问令牌缓存在本地文件中，多个进程和线程共用同一个令牌，过期前自动刷新
+"""
+
+import os
+import json
+import time
+import threading
+import contextlib
+import requests
+
+try:
+    import fcntl
+except ImportError:
+    # 非posix系统不加文件锁，各进程可能各自获取一次令牌
+    fcntl = None
+
+TOKEN_ENDPOINT = '/api/rest/oauth2/token'
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.upsource_hub_tokens.json')
+
+class TokenCache:
+    """
+    访问令牌的文件缓存，读写时加文件锁，文件只有当前用户可读写
+    """
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        self.path = path
+
+    @contextlib.contextmanager
+    def locked(self):
+        """
+        跨进程的互斥锁，持有锁期间其它进程等待，避免同时获取令牌
+        :return:
+        """
+        if fcntl is None:
+            yield
+            return
+        fd = os.open(self.path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as fp:
+                return json.load(fp)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def get(self, key):
+        return self._read().get(key)
+
+    def set(self, key, token):
+        """
+        写入令牌，先写临时文件再替换
+        :param key:
+        :param token: None表示删除
+        :return:
+        """
+        tokens = self._read()
+        now = time.time()
+        # 顺便清理已过期的令牌
+        tokens = {k: t for k, t in tokens.items() if t.get('expires_at', 0) > now}
+        if token is None:
+            tokens.pop(key, None)
+        else:
+            tokens[key] = token
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(tokens, fp)
+        os.rename(tmp_path, self.path)
+
+class PermanentTokenAuth(requests.auth.AuthBase):
+    """
+    Hub永久令牌认证
+    """
+    def __init__(self, token):
+        self.token = token
+
+    def auth_header(self):
+        return 'Bearer {}'.format(self.token)
+
+    def __call__(self, r):
+        r.headers['Authorization'] = self.auth_header()
+        return r
+
+class ClientCredentialsAuth(requests.auth.AuthBase):
+    """
+    OAuth client credentials认证
+    hub_url: 签发令牌的Hub地址
+    client_id, client_secret: Hub中注册的服务id和密钥
+    scope: 令牌可访问的服务id，多个用空格分隔，为None时使用client_id
+    refresh_margin: 过期前多少秒刷新令牌
+    令牌在返回401时(如Hub重启或令牌被吊销)重新获取并重试一次
+    """
+    def __init__(self, hub_url, client_id, client_secret, scope=None, cache=None, refresh_margin=60):
+        self.token_url = hub_url.rstrip('/') + TOKEN_ENDPOINT
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.scope = scope or client_id
+        self.cache = cache or TokenCache()
+        self.refresh_margin = refresh_margin
+        self.cache_key = '{} {} {}'.format(self.token_url, client_id, self.scope)
+        self._token = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _valid(self, token):
+        return token is not None and token['expires_at'] - self.refresh_margin > time.time()
+
+    def _fetch(self):
+        response = requests.post(self.token_url, auth=(self.client_id, self.client_secret),
+                                 data={'grant_type': 'client_credentials', 'scope': self.scope},
+                                 headers={'Accept': 'application/json'}, timeout=(10, 60))
+        if response.status_code != 200:
+            raise requests.exceptions.HTTPError('Failed to get access token from {}: {} {}'.format(
+                self.token_url, response.status_code, response.text), response=response)
+        result = response.json()
+        return {'access_token': result['access_token'], 'expires_at': time.time() + int(result['expires_in'])}
+
+    def access_token(self):
+        """
+        有效的访问令牌：依次使用内存中、缓存文件中的令牌，都将过期时重新获取
+        :return:
+        """
+        with self._lock:
+            if self._valid(self._token):
+                return self._token['access_token']
+            with self.cache.locked():
+                token = self.cache.get(self.cache_key)
+                if not self._valid(token):
+                    token = self._fetch()
+                    self.cache.set(self.cache_key, token)
+            self._token = token
+            return token['access_token']
+
+    def invalidate(self, access_token):
+        """
+        丢弃失效的令牌，其它线程或进程已刷新的令牌不受影响
+        :param access_token:
+        :return:
+        """
+        with self._lock:
+            if self._token is not None and self._token['access_token'] == access_token:
+                self._token = None
+            with self.cache.locked():
+                token = self.cache.get(self.cache_key)
+                if token is not None and token['access_token'] == access_token:
+                    self.cache.set(self.cache_key, None)
+
+    def auth_header(self):
+        return 'Bearer {}'.format(self.access_token())
+
+    def _handle_401(self, r, **kwargs):
+        if r.status_code != 401 or getattr(r.request, '_token_retried', False):
+            return r
+        self.invalidate(r.request.headers['Authorization'][len('Bearer '):])
+        # 释放连接后用新令牌重试一次
+        r.content
+        r.close()
+        prep = r.request.copy()
+        prep.headers['Authorization'] = self.auth_header()
+        prep._token_retried = True
+        retried = r.connection.send(prep, **kwargs)
+        retried.history.append(r)
+        retried.request = prep
+        return retried
+
+    def __call__(self, r):
+        r.headers['Authorization'] = self.auth_header()
+        r.register_hook('response', self._handle_401)
+        return r
+
+def make_auth(token):
+    """
+    客户端的token参数转换为认证对象
+    :param token: 永久令牌字符串或requests认证对象
+    :return:
+    """
+    if token is None or isinstance(token, requests.auth.AuthBase):
+        return token
+    return PermanentTokenAuth(token)
+
+def auth_from_config(config, section):
+    """
+    根据配置创建令牌认证，配置中没有令牌时返回None(使用用户名密码)
+    配置项: token(永久令牌)，或client_id、client_secret、scope(OAuth client credentials)，
+    token_cache(令牌缓存文件)；令牌由config['hub']['url']签发
+    :param config: config.load_config()的返回值
+    :param section: 'hub'或'upsource'
+    :return:
+    """
+    options = config[section]
+    if options.get('token'):
+        return PermanentTokenAuth(options['token'])
+    if options.get('client_id'):
+        cache = TokenCache(options['token_cache']) if options.get('token_cache') else None
+        return ClientCredentialsAuth(config['hub']['url'], options['client_id'], options['client_secret'],
+                                     scope=options.get('scope'), cache=cache)
+    return None
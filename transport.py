@@ -0,0 +1,150 @@
+# -*- coding:utf-8 -*-
+
+"""
+HubClient和UpsourceClient可选的HTTP/2传输层(基于httpx)，并发请求复用少量连接
+接口与requests.Session.request相同，超时和连接异常转换为requests的异常，
+响应对象提供reason属性，客户端的错误处理不需要修改
+"""
+
+import threading
+import requests
+
+class Http2Response:
+    """
+    httpx响应，增加与requests相同的reason属性
+    """
+    def __init__(self, response):
+        self._response = response
+
+    @property
+    def reason(self):
+        return self._response.reason_phrase
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+class Http2Transport:
+    """
+    基于httpx的HTTP/2传输层，需要安装httpx[http2](仅支持python3)
+    httpx同步客户端的HTTP/2连接不能在多个线程中并发使用，
+    因此在单独线程的事件循环中使用httpx.AsyncClient，各线程提交请求后等待结果
+    max_connections: 最大连接数，HTTP/2连接上的并发请求复用同一连接
+    verify: 是否校验HTTPS证书
+    prior_knowledge: 明文http地址直接使用HTTP/2(h2c)，不经过HTTP/1.1协商
+    """
+    def __init__(self, max_connections=4, verify=True, prior_knowledge=False):
+        try:
+            import httpx
+        except ImportError:
+            raise ImportError('HTTP/2 transport requires httpx: pip install "httpx[http2]"')
+        self._httpx = httpx
+        self.max_connections = max_connections
+        self.verify = verify
+        self.prior_knowledge = prior_knowledge
+        self._loop = None
+        self._client = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ('_httpx', '_loop', '_client', '_lock'):
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        import httpx
+        self.__dict__.update(state)
+        self._httpx = httpx
+        self._loop = None
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        import asyncio
+        with self._lock:
+            if self._client is None:
+                self._loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=self._loop.run_forever, name='http2-transport')
+                thread.daemon = True
+                thread.start()
+                self._client = self._httpx.AsyncClient(
+                    http1=not self.prior_knowledge,
+                    http2=True,
+                    verify=self.verify,
+                    follow_redirects=True,
+                    limits=self._httpx.Limits(max_connections=self.max_connections),
+                )
+            return self._loop, self._client
+
+    def close(self):
+        import asyncio
+        with self._lock:
+            if self._client is not None:
+                asyncio.run_coroutine_threadsafe(self._client.aclose(), self._loop).result()
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._loop = None
+                self._client = None
+
+    def _timeout(self, timeout):
+        if isinstance(timeout, tuple):
+            connect, read = timeout
+            return self._httpx.Timeout(read, connect=connect)
+        return self._httpx.Timeout(timeout)
+
+    @staticmethod
+    def _auth(auth, headers):
+        # 令牌认证转换为Authorization请求头，requests.auth.HTTPBasicAuth转换为(用户名, 密码)
+        if hasattr(auth, 'auth_header'):
+            headers = dict(headers or {})
+            headers['Authorization'] = auth.auth_header()
+            return None, headers
+        if auth is not None and hasattr(auth, 'username'):
+            return (auth.username, auth.password), headers
+        return auth, headers
+
+    def request(self, method, url, params=None, data=None, headers=None, files=None, auth=None, timeout=None):
+        """
+        发送请求，参数与requests.Session.request相同
+        :return: Http2Response
+        """
+        import asyncio
+        auth, headers = self._auth(auth, headers)
+        kwargs = {
+            'params': params or None,
+            'headers': headers,
+            'files': files,
+            'auth': auth,
+            'timeout': self._timeout(timeout),
+        }
+        if isinstance(data, bytes):
+            kwargs['content'] = data
+        else:
+            kwargs['data'] = data
+        httpx = self._httpx
+        loop, client = self._start()
+        try:
+            future = asyncio.run_coroutine_threadsafe(client.request(method.upper(), url, **kwargs), loop)
+            return Http2Response(future.result())
+        except httpx.TimeoutException as e:
+            raise requests.exceptions.Timeout(str(e))
+        except httpx.TransportError as e:
+            raise requests.exceptions.ConnectionError(str(e))
+
+def make_transport(http2=False, max_connections=4, verify=True, prior_knowledge=False, urls=()):
+    """
+    创建客户端使用的传输层
+    httpx不会把明文http连接升级为h2c，http地址未开启prior_knowledge时仍使用HTTP/1.1，此时输出警告
+    :param http2: 为False时返回None，客户端使用requests
+    :param max_connections:
+    :param verify:
+    :param prior_knowledge: 明文http地址直接使用HTTP/2(h2c)，服务端或反向代理需支持h2c
+    :param urls: 使用该传输层的服务地址，用于检查明文地址
+    :return:
+    """
+    if not http2:
+        return None
+    cleartext = [url for url in urls if url.startswith('http://')]
+    if cleartext and not prior_knowledge:
+        print('Warning: HTTP/2 is only negotiated over https, {} will use HTTP/1.1; '
+              'enable h2c prior knowledge if the server supports it'.format(', '.join(cleartext)))
+    return Http2Transport(max_connections=max_connections, verify=verify, prior_knowledge=prior_knowledge)
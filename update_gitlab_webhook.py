@@ -6,49 +6,152 @@
 
 import sys
 from upsource_hub_api.UpsourceClient import UpsourceClient
+from upsource_hub_api.deadline import Deadline
+from upsource_hub_api.gitlab_snapshot import GitlabSnapshot, add_max_age_argument
+from upsource_hub_api.token_auth import auth_from_config
+from upsource_hub_api.config import load_config, add_config_argument
 from gitlab_api.base import gitlabapi
 from jenkins_api.base_api import jenkinsapi
 import datetime
-
-if __name__ == '__main__':
+import argparse
+import time
+from multiprocessing.pool import ThreadPool
+
+UPSOURCE_HOOK_URL = 'http://upsource.*.work/~vcs/{}'
+JENKINS_HOOK_URL = 'http://sonar.jenkins.*.work/project/{}'
+
+def plan_project_hooks(gitlab_project_path, existing_hook_urls, upsource_project_names, jenkins_jobs):
+    """
+    计算项目缺少的webhook
+    :param gitlab_project_path:
+    :param existing_hook_urls: 项目已存在的hook url集合
+    :param upsource_project_names: upsource项目名称集合
+    :param jenkins_jobs: jenkins job名称集合
+    :return: [(hook类型, hook url)]
+    """
+    missing = []
+    upsource_project_key = gitlab_project_path.replace('/', '-').replace('.', '-')
+    upsource_hook_url = UPSOURCE_HOOK_URL.format(upsource_project_key)
+    if gitlab_project_path in upsource_project_names and upsource_hook_url not in existing_hook_urls:
+        missing.append(('Upsource', upsource_hook_url))
+
+    job_key = gitlab_project_path.replace('/', '-')
+    sonar_jenkins_hook_url = JENKINS_HOOK_URL.format(job_key)
+    if job_key in jenkins_jobs and sonar_jenkins_hook_url not in existing_hook_urls:
+        missing.append(('Jenkins', sonar_jenkins_hook_url))
+    return missing
+
+def reconcile_webhooks(gitlab_client, gitlab_projects, gitlab_groups, upsource_project_names, jenkins_jobs, processes=8):
+    """
+    并发获取项目已有的webhook，并为缺少hook的项目并发创建
+    :param gitlab_client:
+    :param gitlab_projects: gitlab项目列表
+    :param gitlab_groups: 需要处理的分组
+    :param upsource_project_names: upsource项目名称
+    :param jenkins_jobs: jenkins job名称
+    :param processes: 并发请求数
+    :return: {'created': [...], 'skipped': int, 'failed': [...]}
+    """
+    gitlab_groups = set(gitlab_groups)
+    upsource_project_names = set(upsource_project_names)
+    jenkins_jobs = set(jenkins_jobs)
+    projects = [(item['id'], item['path_with_namespace']) for item in gitlab_projects if item['path_with_namespace'].split('/')[0] in gitlab_groups]
+    report = {'created': [], 'skipped': 0, 'failed': []}
+
+    def fetch_hooks(project):
+        gitlab_project_id, gitlab_project_path = project
+        try:
+            urls = set(h['url'] for h in gitlab_client.projects().list_project_hooks(gitlab_project_id))
+            return project, urls, None
+        except Exception as err:
+            return project, None, err
+
+    def create_hook(hook):
+        gitlab_project_id, gitlab_project_path, kind, url = hook
+        try:
+            gitlab_client.projects().add_project_hook(gitlab_project_id, url)
+            return hook, None
+        except Exception as err:
+            return hook, err
+
+    pool = ThreadPool(processes)
+    try:
+        # 获取已存在的hook url
+        started = time.time()
+        missing_hooks = []
+        for (gitlab_project_id, gitlab_project_path), urls, err in pool.imap_unordered(fetch_hooks, projects):
+            if err is not None:
+                report['failed'].append((gitlab_project_path, None, err))
+                print("List hooks for project {} Failed.".format(gitlab_project_path) + str(err))
+                continue
+            missing = plan_project_hooks(gitlab_project_path, urls, upsource_project_names, jenkins_jobs)
+            if not missing:
+                report['skipped'] += 1
+            for kind, url in missing:
+                missing_hooks.append((gitlab_project_id, gitlab_project_path, kind, url))
+        fetch_time = time.time() - started
+
+        # 创建缺少的hook
+        started = time.time()
+        for (_, gitlab_project_path, kind, url), err in pool.imap_unordered(create_hook, missing_hooks):
+            if err is None:
+                report['created'].append((gitlab_project_path, kind, url))
+                print("Create {} hook url for project {} Successful.".format(kind, gitlab_project_path))
+            else:
+                report['failed'].append((gitlab_project_path, kind, err))
+                print("Create {} hook url for project {} Failed.".format(kind, gitlab_project_path) + str(err))
+        create_time = time.time() - started
+    finally:
+        pool.close()
+        pool.join()
+
+    print("Hooks created: {}, projects skipped: {}, failed: {}. Fetch {:.1f}s, create {:.1f}s".format(
+        len(report['created']), report['skipped'], len(report['failed']), fetch_time, create_time))
+    return report
+
+def add_arguments(parser):
+    """
+    添加命令行参数
+    :param parser:
+    :return:
+    """
+    parser.add_argument('--deadline-hours', type=float, default=2, help='deadline for the whole run, in hours')
+    parser.add_argument('--snapshot', help='GitLab snapshot written by gitlab_snapshot.py, used instead of listing GitLab projects')
+    add_max_age_argument(parser)
+
+def main(config, args):
+    """
+    为gitlab项目创建缺少的webhook
+    :param config: config.load_config()的返回值
+    :param args: 命令行参数
+    :return:
+    """
     today = datetime.datetime.now().strftime('%Y-%m-%d')
     print("Today: " + today)
 
-    gitlab_config = {
-        "gitlab_url": "http://git.*.work",
-        "email": "****",
-        "password": "****"
-    }
+    # 整体运行截止时间，单次请求的超时时间不超过剩余时间
+    run_deadline = Deadline(args.deadline_hours * 3600)
 
     # 连接gitlab
     try:
-        gitlab_client = gitlabapi(**gitlab_config)
+        gitlab_client = gitlabapi(**config['gitlab'])
         print("Connect Gitlab Server Successful")
     except:
         print("Connect Gitlab Server Failed")
         sys.exit(1)
 
-    upsource_config = {
-        "base_url": "http://upsource.*.work",
-        "username": "****",
-        "password": "****"
-    }
     # 连接Upsource
+    upsource_config = config['upsource']
     try:
-        client = UpsourceClient(**upsource_config)
+        client = UpsourceClient(upsource_config['url'], upsource_config['username'], upsource_config['password'], deadline=run_deadline, token=auth_from_config(config, 'upsource'))
         print("Connect Upsource Successful")
     except:
         print("Connect Upsource Failed")
         sys.exit(1)
 
-    jenkins_config = {
-        "jenkins_url": "http://sonar.jenkins.*.work/",
-        "username": "****",
-        "password": "****"
-    }
     # 连接jenkins
     try:
-        jenkins_client = jenkinsapi(**jenkins_config)
+        jenkins_client = jenkinsapi(**config['jenkins'])
         print("Connect Jenkins Successful")
     except:
         print("Connect Jenkins Failed")
@@ -60,39 +163,23 @@ if __name__ == '__main__':
     # 获取所有jenkins项目
     jenkins_jobs = jenkins_client.get_jobs_name()
 
-    #获取gitlab所有项目
-    all_gitlab_projects = gitlab_client.projects().list_projects(simple=True)
-
-    #获取gitlab所有分组
-    all_gitlab_groups = gitlab_client.groups().keys()
-
-    for item in all_gitlab_projects:
-        gitlab_project_path = item['path_with_namespace']
-        gitlab_group = gitlab_project_path.split('/')[0]
-        gitlab_project_id = item['id']
-
-        upsource_project_key = gitlab_project_path.replace('/', '-').replace('.', '-')
-        upsource_hook_url = 'http://upsource.*.work/~vcs/' + upsource_project_key
-
-        job_key = gitlab_project_path.replace('/', '-')
-        sonar_jenkins_hook_url = 'http://sonar.jenkins.*.work/project/' + job_key
-
-        if gitlab_group in all_gitlab_groups:
-            # 已存在的hook url
-            project_hook_urls = [h['url'] for h in gitlab_client.projects().list_project_hooks(gitlab_project_id)]
-
-            # 为upsource项目创建webhook
-            if gitlab_project_path in upsource_project_names and upsource_hook_url not in project_hook_urls:
-                try:
-                    gitlab_client.projects().add_project_hook(gitlab_project_id, upsource_hook_url)
-                    print("Create Upsource hook url for project {} Successful.".format(gitlab_project_path))
-                except Exception as err:
-                    print("Create Upsource hook url for project {} Failed.".format(gitlab_project_path) + str(err))
-
-            # 为Jenkins(sonar)项目创建webhook
-            if job_key in jenkins_jobs and sonar_jenkins_hook_url not in project_hook_urls:
-                try:
-                    gitlab_client.projects().add_project_hook(gitlab_project_id, sonar_jenkins_hook_url)
-                    print("Create Jenkins hook url for project {} Successful.".format(job_key))
-                except Exception as err:
-                    print("Create Jenkins hook url for project {} Failed.".format(job_key) + str(err))
+    if args.snapshot:
+        # 从快照中加载gitlab项目和分组
+        snapshot = GitlabSnapshot.load(args.snapshot, max_age=args.max_snapshot_age * 3600)
+        all_gitlab_projects = snapshot.projects()
+        all_gitlab_groups = snapshot.groups
+    else:
+        #获取gitlab所有项目
+        all_gitlab_projects = gitlab_client.projects().list_projects(simple=True)
+
+        #获取gitlab所有分组
+        all_gitlab_groups = gitlab_client.groups().keys()
+
+    reconcile_webhooks(gitlab_client, all_gitlab_projects, all_gitlab_groups, upsource_project_names, jenkins_jobs)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create missing Upsource and Jenkins webhooks in GitLab projects')
+    add_config_argument(parser)
+    add_arguments(parser)
+    args = parser.parse_args()
+    main(load_config(args.config), args)
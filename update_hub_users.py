@@ -6,13 +6,25 @@
 
 import sys
 from upsource_hub_api.HubClient import HubClient
+from upsource_hub_api.DingtalkDirectory import DingtalkDirectory
+from upsource_hub_api.user_diff import diff_user_streams, UnsortedStreamError, DELETE
+from upsource_hub_api.deadline import Deadline
+from upsource_hub_api.token_auth import auth_from_config
+from upsource_hub_api.config import load_config, add_config_argument
 import requests
 import collections
 import base64
 import datetime
+import argparse
+import threading
 import pymysql
 from gitlab_api.base import gitlabapi
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 reload(sys)
 sys.setdefaultencoding('utf-8')
 
@@ -32,146 +44,263 @@ def get_hub_users(hub):
             hub_user = Hub_User(user_email,email_verified,user_id)
             yield hub_user
 
-if __name__ == '__main__':
-    today = datetime.datetime.now().strftime('%Y-%m-%d')
-    print('Today:' + today)
+def generate_user_data(login, user_name, email):
+    """
+    生成hub用户数据
+    :param login:
+    :param user_name:
+    :param email:
+    :return:
+    """
+    profile = {
+        "email": {
+            "email": "{}".format(email),
+            "type": "EmailJSON",
+            "verified": True
+        }
+    }
+
+    VCSUserNames = [
+        {
+            "name": "{}".format(email)
+        },
+        {
+            "name": "{}".format(login)
+        }
+    ]
 
-    dingtalkdb_config = {
-        'host': '*.*.*.*',
-        'port': 3306,
-        'user': 'sonar',
-        'password': 'sonar',
-        'db': 'dingtalk_develop_members',
-        'charset': 'utf8mb4',
-        'cursorclass': pymysql.cursors.DictCursor,
+    return {
+        'login': login,
+        'profile': profile,
+        'VCSUserNames': VCSUserNames,
+        'name': user_name
     }
 
-    # 连接Dingtalk的数据库
+def normalize_email(email):
+    """
+    邮箱比较时统一去除空白并转为小写
+    :param email:
+    :return:
+    """
+    return (email or '').strip().lower()
+
+def run_stages(items, stages, queue_size=100):
+    """
+    多阶段并发处理：各阶段之间通过有界队列连接，每个阶段有独立的并发数
+    阶段函数返回None时丢弃该条数据，抛出的异常按条记录，不影响其他数据
+    :param items: 输入数据
+    :param stages: [(阶段名称, 处理函数, 并发数)]
+    :param queue_size: 队列长度
+    :return: (最后一个阶段的输出列表, [(输入数据, 阶段名称, 异常)])
+    """
+    stop = object()
+    queues = [queue.Queue(queue_size) for _ in stages]
+    results = []
+    errors = []
+    lock = threading.Lock()
+    remaining_workers = [workers for _, _, workers in stages]
+
+    def worker(index):
+        name, fn, _ = stages[index]
+        while True:
+            item = queues[index].get()
+            if item is stop:
+                break
+            origin, value = item
+            try:
+                value = fn(value)
+            except Exception as e:
+                with lock:
+                    errors.append((origin, name, e))
+                continue
+            if value is None:
+                continue
+            if index + 1 < len(stages):
+                queues[index + 1].put((origin, value))
+            else:
+                with lock:
+                    results.append(value)
+
+        # 本阶段最后一个退出的worker通知下一阶段结束
+        with lock:
+            remaining_workers[index] -= 1
+            last = remaining_workers[index] == 0
+        if last and index + 1 < len(stages):
+            for _ in range(stages[index + 1][2]):
+                queues[index + 1].put(stop)
+
+    threads = []
+    for index, (name, _, workers) in enumerate(stages):
+        for n in range(workers):
+            t = threading.Thread(target=worker, args=(index,), name='{}-{}'.format(name, n))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+    for item in items:
+        queues[0].put((item, item))
+    for _ in range(stages[0][2]):
+        queues[0].put(stop)
+    for t in threads:
+        t.join()
+    return results, errors
+
+def match_hub_users(hub_client, gitlab_users, fields='login,id,profile(email(email))'):
+    """
+    一次遍历按login排序的hub用户，与按小写username排序的gitlab用户归并，同时收集hub中的邮箱
+    hub的排序与小写login不一致时，改为再次获取hub用户并在内存中按login建立索引
+    :param hub_client:
+    :param gitlab_users: [{'email': , 'username': , 'name': }]
+    :param fields:
+    :return: (hub_emails, [(hub_user_id, gitlab_user)])，hub_emails为normalize_email处理后的集合，hub_user_id为None表示hub中没有该login
+    """
+    hub_emails = set()
+
+    def collect(hub_users):
+        for u in hub_users:
+            if 'email' in u.get('profile', {}):
+                hub_emails.add(normalize_email(u['profile']['email']['email']))
+            yield u
+
+    gitlab_users = sorted(gitlab_users, key=lambda u: u['username'].lower())
     try:
-        db = pymysql.connect(**dingtalkdb_config)
-        print("Open Dingtalk Database Successful!")
-        cursor = db.cursor()
-    except Exception as err:
-        print("Failed to Open Dingtalk Database!" + str(err))
-        sys.exit(1)
+        hub_users = collect(hub_client.get_all_users(fields=fields, order_by='login'))
+        matched = [(hub_user['id'] if hub_user is not None else None, gitlab_user)
+                   for event, hub_user, gitlab_user in diff_user_streams(hub_users, gitlab_users) if event != DELETE]
+    except UnsortedStreamError as e:
+        print('Hub login order differs from lowercase login ({}), index Hub users in memory'.format(e))
+        hub_emails.clear()
+        hub_ids = {u['login'].lower(): u['id'] for u in collect(hub_client.get_all_users(fields=fields))}
+        matched = [(hub_ids.get(u['username'].lower()), u) for u in gitlab_users]
+    return hub_emails, matched
+
+def provision_hub_users(hub_client, matched, hub_emails, members_info,
+                        assemble_workers=2, avatar_workers=8, hub_workers=4, deadline=None, avatar_timeout=(10, 30)):
+    """
+    创建或更新hub用户：组装用户数据、下载头像、写入hub三个阶段并发执行
+    邮箱已在hub中的用户已同步，跳过写入；其余用户login已存在时更新，否则创建
+    :param hub_client:
+    :param matched: match_hub_users返回的[(hub_user_id, gitlab_user)]
+    :param hub_emails: match_hub_users返回的hub邮箱集合
+    :param members_info: 钉钉成员信息 {email: {'avatar': }}
+    :param assemble_workers: 组装阶段并发数
+    :param avatar_workers: 头像下载阶段并发数
+    :param hub_workers: hub写入阶段并发数
+    :param deadline: 整体运行截止时间，头像下载的超时时间不超过剩余时间
+    :param avatar_timeout: 头像下载超时时间
+    :return: {'created': [login], 'updated': [login], 'skipped': int, 'failed': [(email, stage, error)]}
+    """
+    # 邮箱已在hub中的用户已同步，不需要写入；其余用户的邮箱与hub中同login的用户必然不同，全部更新
+    candidates = [(hub_user_id, u) for hub_user_id, u in matched if normalize_email(u['email']) not in hub_emails]
+    skipped = len(matched) - len(candidates)
 
-    cursor.execute('select email, name, userid, avatar from dingtalk_members;')
+    def assemble(item):
+        hub_user_id, gitlab_user = item
+        user_data = generate_user_data(gitlab_user['username'], gitlab_user['name'], gitlab_user['email'])
+        return {'email': gitlab_user['email'], 'user_data': user_data, 'hub_user_id': hub_user_id}
 
-    # 获取研发组内成员信息
-    development_center_members_info = {item['email']: {'name': item['name'].decode('utf-8'), 'userid': item['userid'], 'avatar': item['avatar']} for item in cursor.fetchall()}
+    def fetch_avatar(job):
+        # 只为新建用户获取头像
+        if job['hub_user_id'] is None and job['email'] in members_info:
+            dingtalk_user_avatar_url = members_info[job['email']]['avatar']
+            if dingtalk_user_avatar_url:
+                timeout = deadline.timeout(avatar_timeout) if deadline else avatar_timeout
+                response = requests.get(dingtalk_user_avatar_url, timeout=timeout)
+                base64_data = base64.b64encode(response.content)
+                job['user_data']['profile']['avatar'] = {
+                    "type": "urlavatar",
+                    "avatarUrl": "data:image/jpeg;base64,{}".format(base64_data)
+                }
+        return job
 
-    # 关闭Dingtalk数据库
-    db.close()
-    print('Close Dingtalk Database.')
+    def write_user(job):
+        user_data = job['user_data']
+        if job['hub_user_id'] is None:
+            hub_client.create_user(user_data['login'], user_data['name'], user_data['profile'], user_data['VCSUserNames'])
+            print('create user {} in hub.'.format(user_data['login']))
+            return ('created', user_data['login'])
+        hub_client.update_existing_user(job['hub_user_id'], user_data)
+        print('update user {} in hub.'.format(user_data['login']))
+        return ('updated', user_data['login'])
 
-    # gitlab账号信息
-    gitlab_config = {
-        "gitlab_url": "http://git.*.work",
-        "email": "****",
-        "password": "****"
+    stages = [
+        ('assemble', assemble, assemble_workers),
+        ('avatar', fetch_avatar, avatar_workers),
+        ('hub', write_user, hub_workers),
+    ]
+    results, errors = run_stages(candidates, stages)
+    errors = [(gitlab_user['email'], stage, err) for (_, gitlab_user), stage, err in errors]
+    for email, stage, err in errors:
+        print('{} user {} failed: {}'.format(stage, email, err))
+    return {
+        'created': [login for action, login in results if action == 'created'],
+        'updated': [login for action, login in results if action == 'updated'],
+        'skipped': skipped,
+        'failed': errors,
     }
 
+def add_arguments(parser):
+    """
+    添加命令行参数
+    :param parser:
+    :return:
+    """
+    parser.add_argument('--deadline-hours', type=float, default=2, help='deadline for the whole run, in hours')
+
+def main(config, args):
+    """
+    在hub平台上同步gitlab用户数据
+    :param config: config.load_config()的返回值
+    :param args: 命令行参数
+    :return:
+    """
+    today = datetime.datetime.now().strftime('%Y-%m-%d')
+    print('Today:' + today)
+
+    # 整体运行截止时间，单次请求的超时时间不超过剩余时间
+    run_deadline = Deadline(args.deadline_hours * 3600)
+
     # 连接gitlab
     try:
-        gitlab_client = gitlabapi(**gitlab_config)
+        gitlab_client = gitlabapi(**config['gitlab'])
         print("Connect Gitlab Server Successfull")
     except Exception as e:
         print("Connect Gitlab Server Failed: " + str(e))
         sys.exit(1)
 
-    # hub配置信息
-    hub_config = {
-        'hub_url': 'http://upsource.*.work/hub',
-        'hub_username': "****",
-        'hub_password': "****"
-    }
-
     # 连接hub
-    hub_client = HubClient(hub_config['hub_url'], hub_config['hub_username'], hub_config['hub_password'])
+    hub_config = config['hub']
+    hub_client = HubClient(hub_config['url'], hub_config['username'], hub_config['password'], deadline=run_deadline, hedge=True, token=auth_from_config(config, 'hub'))
     print('{} connect successfull.'.format(hub_client))
 
-    # 获取hub中用户信息
-    hub_all_users = list(hub_client.get_all_users(fields='profile,id,login'))
-    hub_user_logins = [u['login'] for u in hub_all_users]
-    hub_user_emails = [u['profile']['email']['email'] for u in hub_all_users if 'email' in u['profile']]
-    hub_users_data = {u['login']: u['id'] for u in hub_all_users}
-
     # 获取gitlab用户信息
-    gitlab_users_info = {item['email']: {'username': item['username'], 'name': item['name']} for item in gitlab_client.users().list_users(active='true')}
+    gitlab_users = [{'email': item['email'], 'username': item['username'], 'name': item['name']} for item in gitlab_client.users().list_users(active='true')]
 
-    # hub中需要创建的用户
-    need_created_user_emails = list(set(gitlab_users_info.keys()) - set(hub_user_emails))
+    # 一次遍历hub用户，按login与gitlab用户归并，只保留邮箱和用户id
+    hub_emails, matched = match_hub_users(hub_client, gitlab_users)
 
-    for email in need_created_user_emails:
-        user_name = gitlab_users_info[email]['name']
-        login = gitlab_users_info[email]['username']
-
-        if login not in hub_user_logins:
-            profile = {
-                "email": {
-                    "email": "{}".format(email),
-                    "type": "EmailJSON",
-                    "verified": True
-                }
-            }
-
-            # 获取用户头像
-            if email in development_center_members_info:
-                dingtalk_user_avatar_url = development_center_members_info[email]['avatar']
-                if dingtalk_user_avatar_url:
-                    response = requests.get(dingtalk_user_avatar_url)
-                    avatar_content = response.content
-                    base64_data = base64.b64encode(avatar_content)
-                    profile['avatar'] = {
-                        "type": "urlavatar",
-                        "avatarUrl": "data:image/jpeg;base64,{}".format(base64_data)
-                    }
-
-            VCSUserNames = [
-                {
-                    "name": "{}".format(email)
-                },
-                {
-                    "name": "{}".format(login)
-                }
-            ]
-
-            # 创建hub用户
-            try:
-                hub_client.create_user(login, user_name, profile, VCSUserNames)
-                print('create user {} in hub.'.format(login))
-            except Exception as e:
-                print(e)
-
-        else:
-            profile = {
-                "email": {
-                    "email": "{}".format(email),
-                    "type": "EmailJSON",
-                    "verified": True
-                }
-            }
-
-            VCSUserNames = [
-                {
-                    "name": "{}".format(email)
-                },
-                {
-                    "name": "{}".format(login)
-                }
-            ]
-
-            user_data = {
-                'login': login,
-                'profile': profile,
-                'VCSUserNames': VCSUserNames,
-                'name': user_name
-            }
+    # 连接Dingtalk的数据库，只查询需要创建的用户的头像信息
+    need_created_user_emails = [u['email'] for hub_user_id, u in matched if hub_user_id is None and normalize_email(u['email']) not in hub_emails]
+    try:
+        db = pymysql.connect(**config['dingtalk_db'])
+        print("Open Dingtalk Database Successful!")
+    except Exception as err:
+        print("Failed to Open Dingtalk Database!" + str(err))
+        sys.exit(1)
+    try:
+        development_center_members_info = DingtalkDirectory.from_pymysql(db).lookup(need_created_user_emails)
+    finally:
+        # 关闭Dingtalk数据库
+        db.close()
+        print('Close Dingtalk Database.')
 
-            # 更新用户数据
-            try:
-                hub_client.update_existing_user(hub_users_data[login], user_data)
-                print('update user {} in hub.'.format(login))
-            except Exception as e:
-                print(e)
+    report = provision_hub_users(hub_client, matched, hub_emails, development_center_members_info, deadline=run_deadline)
+    print('created: {}, updated: {}, failed: {}, {} user writes skipped, email already in hub.'.format(
+        len(report['created']), len(report['updated']), len(report['failed']), report['skipped']))
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sync active GitLab users to Hub')
+    add_config_argument(parser)
+    add_arguments(parser)
+    args = parser.parse_args()
+    main(load_config(args.config), args)
@@ -5,15 +5,72 @@
 """
 
 import json
+import copy
 import sys
-from upsource_hub_api.UpsourceClient import UpsourceClient
+from upsource_hub_api.deadline import Deadline
+from upsource_hub_api.UpsourceClient import UpsourceClient, ProjectCreationPipeline
 from gitlab_api.base import gitlabapi
 from utils.common import judge_day
-import time
 import datetime
 import pprint
 import os
+import argparse
+from multiprocessing.pool import ThreadPool
 from gitlab_utils import get_gitlab_pages_project_info
+from upsource_hub_api.gitlab_snapshot import GitlabSnapshot, add_max_age_argument
+from upsource_hub_api.token_auth import auth_from_config
+from upsource_hub_api.config import load_config, add_config_argument
+
+# 按(项目类型, maven配置)缓存的项目设置公共部分
+_project_settings_templates = {}
+
+def load_settings_files(config_path):
+    """
+    读取私钥和maven配置文件
+    :param config_path: 配置目录
+    :return: (vcsPrivateKey, maven_settings)
+    """
+    with open(os.path.join(config_path, 'id_rsa'), "r") as fp:
+        vcsPrivateKey = fp.read()
+    with open(os.path.join(config_path, 'settings.xml'), "r") as fp:
+        maven_settings = fp.read()
+    return vcsPrivateKey, maven_settings
+
+def get_project_settings_template(project_type, maven_settings):
+    """
+    获取与具体项目无关的项目设置，结果会被缓存
+    :param project_type:
+    :param maven_settings:
+    :return:
+    """
+    cache_key = (project_type == 'java', maven_settings if project_type == 'java' else None)
+    template = _project_settings_templates.get(cache_key)
+    if template is None:
+        template = {}
+        template['addMergeCommitsToBranchReview'] = False
+        template['authorCanCloseReview'] = True
+        template['authorCanDeleteReview'] = True
+        template['buildStatusReceiveToken'] = ''
+        template['checkIntervalSeconds'] = 43200
+        template['defaultEncoding'] = 'UTF-8'
+        template['gradleInitScript'] = ''
+        template['gradleProperties'] = ''
+        template['limitResolveDiscussion'] = True
+        template['mavenProfiles'] = ''
+        template['modelConversionSystemProperties'] = ''
+        template['skipFileContentsImport'] = ['*.bin','*.dll','*.exe','*.so']
+
+        if project_type == 'java':
+            template['mavenSettings'] = maven_settings
+            template['projectModel'] = {'type':'maven', 'pathToModel':''}
+            template['javascriptLanguageLevel'] = 'none'
+        else:
+            template['javascriptLanguageLevel'] = 'none'
+            template['projectModel'] = {'type':'none', 'pathToModel':''}
+
+        template['runInspections'] = False
+        _project_settings_templates[cache_key] = template
+    return template
 
 def generate_project_settings(project_path, default_branch, project_type, maven_settings, vcsPrivateKey):
     """
@@ -37,90 +94,103 @@ def generate_project_settings(project_path, default_branch, project_type, maven_
     pattern = ''.join([word[0].upper() for word in project_path.replace('/','-').split('-')])
 
     # 初始化项目设置
-    project_settings = {}
-    project_settings['addMergeCommitsToBranchReview'] = False
-    project_settings['authorCanCloseReview'] = True
-    project_settings['authorCanDeleteReview'] = True
-    project_settings['buildStatusReceiveToken'] = ''
-    project_settings['checkIntervalSeconds'] = 43200
+    project_settings = copy.deepcopy(get_project_settings_template(project_type, maven_settings))
     project_settings['codeReviewIdPattern'] = pattern + '-CR-{}'
     project_settings['defaultBranch'] = default_branch
-    project_settings['defaultEncoding'] = 'UTF-8'
-    project_settings['gradleInitScript'] = ''
-    project_settings['gradleProperties'] = ''
-    project_settings['limitResolveDiscussion'] = True
-    project_settings['mavenProfiles'] = ''
-    project_settings['modelConversionSystemProperties'] = ''
     project_settings['projectName'] = project_path
-
-    project_settings['skipFileContentsImport'] = ['*.bin','*.dll','*.exe','*.so'] 
     project_settings['vcsSettings'] = json.dumps(vcs)
 
-    if project_type == 'java':
-        project_settings['mavenSettings'] = maven_settings
-        project_settings['projectModel'] = {'type':'maven', 'pathToModel':''}
-        project_settings['javascriptLanguageLevel'] = 'none'
-    else:
-        project_settings['javascriptLanguageLevel'] = 'none'
-        project_settings['projectModel'] = {'type':'none', 'pathToModel':''}
-
-    project_settings['runInspections'] = False
-
     return project_settings
 
-def judge_project_isready(client, project_id):
+def has_commits(gitlab_client, project_id):
     """
-    判断项目是否同步完成
-    :param client:
+    判断项目是否存在提交，只读取第一条提交记录
+    :param gitlab_client:
     :param project_id:
     :return:
     """
-    projects = client.GET('getAllProjects', {'projectId': project_id})
-    return projects['project'][0]['isReady'] if projects else False
+    commits = gitlab_client.projects().list_project_commits(project_id)
+    return next(iter(commits), None) is not None
 
-if __name__ == '__main__':
+def screen_candidates(gitlab_client, project_infos, today, existing_project_ids, path_whitelist, gitlab_groups, max_inactive_days=90, processes=8):
+    """
+    筛选需要创建的项目：先执行名单、分组、活跃时间等本地检查，再并发检查项目是否有提交
+    :param gitlab_client:
+    :param project_infos: get_gitlab_pages_project_info返回的项目信息
+    :param today:
+    :param existing_project_ids: upsource中已存在的项目id集合
+    :param path_whitelist: 过滤的项目路径集合
+    :param gitlab_groups: 需要处理的分组集合
+    :param max_inactive_days: 超过该天数未活跃的项目不创建
+    :param processes: 并发请求数
+    :return: [(project_path, default_branch, project_type)]
+    """
+    candidates = []
+    for project_path, value in project_infos.items():
+        if project_path in path_whitelist or project_path.split('/')[0] not in gitlab_groups:
+            continue
+        if project_path.replace('/', '-').replace('.', '-') in existing_project_ids:
+            continue
+        if judge_day(value['last_activity_day'], today) >= max_inactive_days:
+            continue
+        candidates.append((project_path, value))
+
+    if not candidates:
+        return []
+    pool = ThreadPool(min(processes, len(candidates)))
+    try:
+        checks = pool.map(lambda item: has_commits(gitlab_client, item[1]['project_id']), candidates)
+    finally:
+        pool.close()
+        pool.join()
+    return [(project_path, value['default_branch'], value['project_type']) for (project_path, value), ok in zip(candidates, checks) if ok]
+
+def add_arguments(parser):
+    """
+    添加命令行参数
+    :param parser:
+    :return:
+    """
+    parser.add_argument('--deadline-hours', type=float, default=12, help='deadline for the whole run, in hours')
+    parser.add_argument('--snapshot', help='GitLab snapshot written by gitlab_snapshot.py, used instead of crawling GitLab')
+    add_max_age_argument(parser)
+    parser.add_argument('--max-indexing', type=int, default=5, help='maximum number of projects creating or indexing at once')
+
+def main(config, args):
+    """
+    创建upsource项目
+    :param config: config.load_config()的返回值
+    :param args: 命令行参数
+    :return:
+    """
     today = datetime.datetime.now().strftime('%Y-%m-%d')
     print("Today: " + today)
 
+    # 整体运行截止时间，单次请求的超时时间不超过剩余时间
+    run_deadline = Deadline(args.deadline_hours * 3600)
+
     # Upsource server URL and login credentials
-    upsource_config = {
-        'upsource_url': 'http://upsource.*.work',
-        'upsource_username': "****",
-        'upsource_password': "****"
-    }
-    upsource_client = UpsourceClient(upsource_config['upsource_url'], upsource_config['upsource_username'], upsource_config['upsource_password'])
+    upsource_config = config['upsource']
+    upsource_client = UpsourceClient(upsource_config['url'], upsource_config['username'], upsource_config['password'], deadline=run_deadline, hedge=True, token=auth_from_config(config, 'upsource'))
     print('{} connect successful.'.format(upsource_client))
 
-    # 加载私钥
+    # 加载私钥和maven setting文件
     script_path = os.path.split(os.path.realpath(__file__))[0]
-    vcsPrivateKeyFile = 'id_rsa'
-    with open(os.path.join(script_path, 'config', vcsPrivateKeyFile), "r") as fp:
-        vcsPrivateKey = fp.read()
-
-    # 加载maven setting文件
-    maven_settings_File = 'settings.xml'
-    with open(os.path.join(script_path, 'config', maven_settings_File), "r") as fp:
-        maven_settings = fp.read()
+    vcsPrivateKey, maven_settings = load_settings_files(os.path.join(script_path, 'config'))
 
-    # gitlab账号信息
-    gitlab_config = {
-        "gitlab_url": "http://git.*.work",
-        "email": "*",
-        "password": "*"
-    }
     # 连接gitlab服务器
     try:
-        gitlab_client = gitlabapi(**gitlab_config)
+        gitlab_client = gitlabapi(**config['gitlab'])
         print("Connect Gitlab Successful")
     except Exception as e:
         print("Connect Gitlab Failed: " + str(e))
         sys.exit(1)
 
     # 获取所有项目
-    project_ids = upsource_client.get_all_project_ids()
+    project_ids = set(upsource_client.get_all_project_ids())
 
     # 过滤名单
-    path_whitelist = ['cocoapods/QIYU_iOS_SDK',
+    path_whitelist = {'cocoapods/QIYU_iOS_SDK',
 'scm/csvn_conf',
 'test/biaozhunjinjian-xinzengjiekuanren_cunguanzhanghujihuo',
 'test/jinjianzhongxin-chexiaofeijinrongjiekoujichenghuaceshi',
@@ -129,48 +199,47 @@ if __name__ == '__main__':
 'fed/admin.bwcrm',
 'scm/jenkins-fed-bak',
 'wechat/credit.treasure',
-'scm/jenkins-bak']
+'scm/jenkins-bak'}
     group_whitelist = ['Component']
-    all_gitlab_groups = list(set(gitlab_client.groups().keys()) - set(group_whitelist))
 
     project_infos = []
-    #获取项目成员
-    count_pages = 20
-    start_page = 1
-    while True:
-        numbers, _, results = get_gitlab_pages_project_info(gitlab_client, all_gitlab_groups, start_page, start_page + count_pages, need_info="default_branch,last_activity_day,project_type")
-        for project_path, value in results.items():
-            project_id = value['project_id']
-            default_branch = value['default_branch']
-            last_activity_day = value['last_activity_day']
-            project_type = value['project_type']
-            if project_path not in path_whitelist and project_path.split('/')[0] in all_gitlab_groups and project_path.replace('/', '-').replace('.', '-') not in project_ids:
-                if judge_day(last_activity_day, today) < 90:
-                    if len(list(gitlab_client.projects().list_project_commits(project_id))):
-                        project_infos.append((project_path, default_branch, project_type))
-        start_page += count_pages
-        if numbers != 20 * count_pages:
-            break
+    if args.snapshot:
+        # 从快照中加载项目信息并筛选需要创建的项目
+        snapshot = GitlabSnapshot.load(args.snapshot, max_age=args.max_snapshot_age * 3600)
+        gitlab_groups = set(snapshot.groups) - set(group_whitelist)
+        project_infos.extend(screen_candidates(gitlab_client, snapshot.project_info, today, project_ids, path_whitelist, gitlab_groups))
+    else:
+        all_gitlab_groups = list(set(gitlab_client.groups().keys()) - set(group_whitelist))
+        gitlab_groups = set(all_gitlab_groups)
+
+        #获取项目信息并筛选需要创建的项目
+        count_pages = 20
+        start_page = 1
+        while True:
+            numbers, _, results = get_gitlab_pages_project_info(gitlab_client, all_gitlab_groups, start_page, start_page + count_pages, need_info="default_branch,last_activity_day,project_type")
+            project_infos.extend(screen_candidates(gitlab_client, results, today, project_ids, path_whitelist, gitlab_groups))
+            start_page += count_pages
+            if numbers != 20 * count_pages:
+                break
 
     print('Creating Projects:')
     pprint.pprint(project_infos)
 
-    while len(project_infos) != 0:
-        project_path, default_branch, project_type = project_infos.pop()
-        print('operating project: {}, default branch: {}, project_type: {}'.format(project_path, default_branch, project_type))
-        #创建项目
+    # 并发创建项目，同时索引中的项目不超过args.max_indexing个
+    projects = []
+    for project_path, default_branch, project_type in project_infos:
         project_id = project_path.replace('/', '-').replace('.', '-')
         if project_id not in project_ids:
-            try:
-                project_settings = generate_project_settings(project_path, default_branch, project_type, maven_settings, vcsPrivateKey)
-                upsource_client.create_project(project_id, project_settings)
-                print('Create project {}'.format(project_path))
-            except Exception as e:
-                print(e)
-
-        #等待项目同步完成，最多等待5分钟时间
-        count = 0
-        while not judge_project_isready(upsource_client, project_id) and count < 30:
-            print('Waiting...')
-            time.sleep(10)
-            count += 1
+            project_settings = generate_project_settings(project_path, default_branch, project_type, maven_settings, vcsPrivateKey)
+            projects.append((project_id, project_settings))
+
+    pipeline = ProjectCreationPipeline(upsource_client, max_indexing=args.max_indexing)
+    result = pipeline.run(projects)
+    print('Ready: {}, still indexing: {}, failed: {}'.format(len(result['ready']), len(result['timed_out']), len(result['failed'])))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create Upsource projects for active GitLab projects')
+    add_config_argument(parser)
+    add_arguments(parser)
+    args = parser.parse_args()
+    main(load_config(args.config), args)
@@ -0,0 +1,163 @@
+# -*- coding:utf-8 -*-
+
+"""
+此脚本用于修正upsource项目配置，只更新与期望配置不一致的项目
+"""
+
+import json
+import sys
+import argparse
+import datetime
+import os
+from multiprocessing.pool import ThreadPool
+from upsource_hub_api.deadline import Deadline
+from upsource_hub_api.UpsourceClient import UpsourceClient
+from upsource_hub_api.token_auth import auth_from_config
+from upsource_hub_api.config import load_config, add_config_argument
+from upsource_create_project import generate_project_settings, load_settings_files
+from gitlab_api.base import gitlabapi
+from gitlab_utils import get_gitlab_pages_project_info
+
+def normalize_vcs_settings(vcs_settings):
+    """
+    将vcsSettings(JSON字符串)转换为可比较的结构，忽略服务端生成的mapping id
+    :param vcs_settings:
+    :return:
+    """
+    if not vcs_settings:
+        return None
+    vcs = vcs_settings if isinstance(vcs_settings, dict) else json.loads(vcs_settings)
+    mappings = []
+    for mapping in vcs.get('mappings', []):
+        mapping = {k: v for k, v in mapping.items() if k != 'id'}
+        mappings.append(mapping)
+    vcs = dict(vcs)
+    vcs['mappings'] = sorted(mappings, key=lambda m: (m.get('mapping'), m.get('url')))
+    return vcs
+
+def diff_project_settings(current, desired):
+    """
+    逐字段比较项目配置
+    :param current: 当前配置
+    :param desired: 期望配置
+    :return: 不一致的字段名列表
+    """
+    current = current or {}
+    changed = []
+    for field, value in desired.items():
+        if field == 'vcsSettings':
+            if normalize_vcs_settings(current.get(field)) != normalize_vcs_settings(value):
+                changed.append(field)
+        elif current.get(field) != value:
+            changed.append(field)
+    return sorted(changed)
+
+def reconcile_project_settings(upsource_client, desired_settings, processes=8, dry_run=False):
+    """
+    并发加载项目配置，只对存在差异的项目调用editProject
+    :param upsource_client:
+    :param desired_settings: {project_id: project_settings}
+    :param processes: 并发请求数
+    :param dry_run: 只输出差异，不修改
+    :return: {'unchanged': [project_id], 'updated': [(project_id, fields)], 'failed': [(project_id, error)]}
+    """
+    def reconcile(item):
+        project_id, desired = item
+        try:
+            current = upsource_client.load_project_settings(project_id)
+            changed = diff_project_settings(current, desired)
+            if changed and not dry_run:
+                settings = dict(current or {})
+                settings.update(desired)
+                upsource_client.edit_project_settings(project_id, settings)
+            return project_id, changed, None
+        except Exception as e:
+            return project_id, None, e
+
+    report = {'unchanged': [], 'updated': [], 'failed': []}
+    if not desired_settings:
+        return report
+    pool = ThreadPool(min(processes, len(desired_settings)))
+    try:
+        for project_id, changed, err in pool.imap_unordered(reconcile, desired_settings.items()):
+            if err is not None:
+                report['failed'].append((project_id, err))
+                print('Reconcile project {} failed: {}'.format(project_id, err))
+            elif changed:
+                report['updated'].append((project_id, changed))
+                print('Update project {}: {}'.format(project_id, ', '.join(changed)))
+            else:
+                report['unchanged'].append(project_id)
+    finally:
+        pool.close()
+        pool.join()
+    return report
+
+def add_arguments(parser):
+    """
+    添加命令行参数
+    :param parser:
+    :return:
+    """
+    parser.add_argument('--deadline-hours', type=float, default=2, help='deadline for the whole run, in hours')
+    parser.add_argument('--dry-run', action='store_true', help='only print the differences')
+
+def main(config, args):
+    """
+    修正upsource项目配置
+    :param config: config.load_config()的返回值
+    :param args: 命令行参数
+    :return:
+    """
+    today = datetime.datetime.now().strftime('%Y-%m-%d')
+    print("Today: " + today)
+
+    # 整体运行截止时间，单次请求的超时时间不超过剩余时间
+    run_deadline = Deadline(args.deadline_hours * 3600)
+
+    # Upsource server URL and login credentials
+    upsource_config = config['upsource']
+    upsource_client = UpsourceClient(upsource_config['url'], upsource_config['username'], upsource_config['password'], deadline=run_deadline, hedge=True, token=auth_from_config(config, 'upsource'))
+    print('{} connect successful.'.format(upsource_client))
+
+    # 加载私钥和maven setting文件
+    script_path = os.path.split(os.path.realpath(__file__))[0]
+    vcsPrivateKey, maven_settings = load_settings_files(os.path.join(script_path, 'config'))
+
+    # 连接gitlab服务器
+    try:
+        gitlab_client = gitlabapi(**config['gitlab'])
+        print("Connect Gitlab Successful")
+    except Exception as e:
+        print("Connect Gitlab Failed: " + str(e))
+        sys.exit(1)
+
+    # 获取所有项目
+    project_ids = set(upsource_client.get_all_project_ids())
+
+    group_whitelist = ['Component']
+    all_gitlab_groups = list(set(gitlab_client.groups().keys()) - set(group_whitelist))
+
+    # 生成已存在项目的期望配置
+    desired_settings = {}
+    count_pages = 20
+    start_page = 1
+    while True:
+        numbers, _, results = get_gitlab_pages_project_info(gitlab_client, all_gitlab_groups, start_page, start_page + count_pages, need_info="default_branch,last_activity_day,project_type")
+        for project_path, value in results.items():
+            project_id = project_path.replace('/', '-').replace('.', '-')
+            if project_id in project_ids:
+                desired_settings[project_id] = generate_project_settings(project_path, value['default_branch'], value['project_type'], maven_settings, vcsPrivateKey)
+        start_page += count_pages
+        if numbers != 20 * count_pages:
+            break
+
+    report = reconcile_project_settings(upsource_client, desired_settings, dry_run=args.dry_run)
+    print('Unchanged: {}, updated: {}, failed: {}'.format(len(report['unchanged']), len(report['updated']), len(report['failed'])))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reconcile Upsource project settings with the generated settings')
+    add_config_argument(parser)
+    add_arguments(parser)
+    args = parser.parse_args()
+    main(load_config(args.config), args)
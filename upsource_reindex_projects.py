@@ -0,0 +1,106 @@
+# -*- coding:utf-8 -*-
+
+"""
+此脚本用于upsource升级后批量重置项目，同时重新索引的项目数受限，最近活跃的项目优先
+"""
+
+import sys
+import argparse
+import datetime
+from upsource_hub_api.UpsourceClient import UpsourceClient, ProjectReindexScheduler
+from upsource_hub_api.deadline import Deadline
+from upsource_hub_api.gitlab_snapshot import GitlabSnapshot, add_max_age_argument
+from upsource_hub_api.token_auth import auth_from_config
+from upsource_hub_api.config import load_config, add_config_argument
+
+def load_last_activity(config, args):
+    """
+    gitlab项目最近活跃日期，键为upsource项目id
+    :param config:
+    :param args:
+    :return: {project_id: 'YYYY-MM-DD'}
+    """
+    if args.snapshot:
+        project_info = GitlabSnapshot.load(args.snapshot, max_age=args.max_snapshot_age * 3600).project_info
+    else:
+        from gitlab_api.base import gitlabapi
+        from gitlab_utils import get_gitlab_pages_project_info
+
+        # 连接gitlab
+        try:
+            gitlab_client = gitlabapi(**config['gitlab'])
+            print("Connect Gitlab Successful")
+        except Exception as e:
+            print("Connect Gitlab Failed: " + str(e))
+            sys.exit(1)
+
+        all_gitlab_groups = list(gitlab_client.groups().keys())
+        project_info = {}
+        count_pages = 20
+        start_page = 1
+        while True:
+            numbers, _, results = get_gitlab_pages_project_info(gitlab_client, all_gitlab_groups, start_page, start_page + count_pages, need_info="last_activity_day")
+            project_info.update(results)
+            start_page += count_pages
+            if numbers != 20 * count_pages:
+                break
+    return {path.replace('/', '-').replace('.', '-'): info.get('last_activity_day') for path, info in project_info.items()}
+
+def add_arguments(parser):
+    """
+    添加命令行参数
+    :param parser:
+    :return:
+    """
+    parser.add_argument('projects', nargs='*', help='Upsource project ids to reset (default: all projects)')
+    parser.add_argument('--deadline-hours', type=float, default=48, help='deadline for the whole run, in hours')
+    parser.add_argument('--snapshot', help='GitLab snapshot written by gitlab_snapshot.py, used instead of crawling GitLab')
+    add_max_age_argument(parser)
+    parser.add_argument('--max-indexing', type=int, default=5, help='maximum number of projects re-indexing at once')
+    parser.add_argument('--readiness-timeout', type=float, default=7200, help='seconds to wait for a project to finish re-indexing')
+    parser.add_argument('--dry-run', action='store_true', help='only print the reset order')
+
+def main(config, args):
+    """
+    批量重置upsource项目
+    :param config: config.load_config()的返回值
+    :param args: 命令行参数
+    :return:
+    """
+    today = datetime.datetime.now().strftime('%Y-%m-%d')
+    print("Today: " + today)
+
+    # 整体运行截止时间，单次请求的超时时间不超过剩余时间
+    run_deadline = Deadline(args.deadline_hours * 3600)
+
+    # Upsource server URL and login credentials
+    upsource_config = config['upsource']
+    upsource_client = UpsourceClient(upsource_config['url'], upsource_config['username'], upsource_config['password'], deadline=run_deadline, hedge=True, token=auth_from_config(config, 'upsource'))
+    print('{} connect successful.'.format(upsource_client))
+
+    project_ids = upsource_client.get_all_project_ids()
+    if args.projects:
+        unknown = set(args.projects) - set(project_ids)
+        if unknown:
+            print('Unknown projects: {}'.format(', '.join(sorted(unknown))))
+            sys.exit(1)
+        project_ids = args.projects
+
+    last_activity = load_last_activity(config, args)
+    projects = [(project_id, last_activity.get(project_id)) for project_id in project_ids]
+
+    scheduler = ProjectReindexScheduler(upsource_client, max_indexing=args.max_indexing, readiness_timeout=args.readiness_timeout)
+    if args.dry_run:
+        for project_id in scheduler.prioritize(projects):
+            print('reset {} (last activity: {})'.format(project_id, last_activity.get(project_id)))
+        return
+
+    result = scheduler.run(projects)
+    print('Ready: {}, still indexing: {}, failed: {}'.format(len(result['ready']), len(result['timed_out']), len(result['failed'])))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reset Upsource projects for re-indexing with a limit on concurrent indexing')
+    add_config_argument(parser)
+    add_arguments(parser)
+    args = parser.parse_args()
+    main(load_config(args.config), args)
@@ -0,0 +1,62 @@
+# -*- coding:utf-8 -*-
+
+"""
+按login排序的用户流归并比较，内存占用只与分页大小有关
+"""
+
+ADD = 'add'
+UPDATE = 'update'
+DELETE = 'delete'
+
+class UnsortedStreamError(ValueError):
+    """
+    数据流没有按排序键升序排列，无法归并比较
+    """
+    pass
+
+def _checked(stream, key, name):
+    """
+    检查数据流按key升序排列
+    :param stream:
+    :param key:
+    :param name: 数据流名称，用于错误信息
+    :return:
+    """
+    previous = None
+    for item in stream:
+        current = key(item)
+        if previous is not None and current < previous:
+            raise UnsortedStreamError('{} stream is not sorted: {!r} after {!r}'.format(name, current, previous))
+        previous = current
+        yield current, item
+
+def diff_user_streams(hub_users, gitlab_users, hub_key=None, gitlab_key=None, changed=None):
+    """
+    归并比较两个按login升序排列的用户流
+    :param hub_users: hub用户流，如get_all_users(order_by='login')
+    :param gitlab_users: gitlab用户流
+    :param hub_key: 从hub用户中取排序键，默认为小写login
+    :param gitlab_key: 从gitlab用户中取排序键，默认为小写username
+    :param changed: changed(hub_user, gitlab_user)判断是否需要更新，默认总是返回update事件
+    :return: 逐个返回(event, hub_user, gitlab_user)，event为'add'、'update'或'delete'
+    """
+    hub_key = hub_key or (lambda u: u['login'].lower())
+    gitlab_key = gitlab_key or (lambda u: u['username'].lower())
+    hub_iter = _checked(hub_users, hub_key, 'Hub')
+    gitlab_iter = _checked(gitlab_users, gitlab_key, 'GitLab')
+    end = (None, None)
+
+    hub_login, hub_user = next(hub_iter, end)
+    gitlab_login, gitlab_user = next(gitlab_iter, end)
+    while hub_user is not None or gitlab_user is not None:
+        if gitlab_user is None or (hub_user is not None and hub_login < gitlab_login):
+            yield DELETE, hub_user, None
+            hub_login, hub_user = next(hub_iter, end)
+        elif hub_user is None or gitlab_login < hub_login:
+            yield ADD, None, gitlab_user
+            gitlab_login, gitlab_user = next(gitlab_iter, end)
+        else:
+            if changed is None or changed(hub_user, gitlab_user):
+                yield UPDATE, hub_user, gitlab_user
+            hub_login, hub_user = next(hub_iter, end)
+            gitlab_login, gitlab_user = next(gitlab_iter, end)
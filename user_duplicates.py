@@ -0,0 +1,59 @@
+# -*- coding:utf-8 -*-
+
+"""
+在一次遍历中按邮箱为hub用户建立索引，找出重复账号并生成合并计划
+"""
+
+import collections
+
+def user_email(user):
+    """
+    用户邮箱(小写)，没有邮箱时返回None
+    :param user: 包含profile(email(email))字段的hub用户
+    :return:
+    """
+    email = ((user.get('profile') or {}).get('email') or {}).get('email')
+    return email.strip().lower() if email else None
+
+def index_users(users, key=user_email):
+    """
+    按key为用户建立索引
+    :param users: 用户流，如get_all_users()
+    :param key: 从用户中取索引键，返回None的用户不加入索引
+    :return: {key: [user]}，保持用户流中的顺序
+    """
+    index = collections.OrderedDict()
+    for user in users:
+        k = key(user)
+        if k is not None:
+            index.setdefault(k, []).append(user)
+    return index
+
+def find_duplicate_users(index):
+    """
+    索引中对应多个用户的键
+    :param index: index_users的返回值
+    :return: {key: [user]}
+    """
+    return collections.OrderedDict((k, users) for k, users in index.items() if len(users) > 1)
+
+def choose_target(users):
+    """
+    重复账号中保留的用户：优先未禁用，其次最近访问，再次login最短(通常是原始账号)
+    :param users:
+    :return:
+    """
+    return min(users, key=lambda u: (bool(u.get('banned')), -(u.get('lastAccessTime') or 0), len(u['login']), u['login']))
+
+def plan_user_merges(duplicates, choose=choose_target):
+    """
+    生成合并计划
+    :param duplicates: find_duplicate_users的返回值
+    :param choose: 从重复账号中选择保留的用户
+    :return: [(key, target_user, [source_user])]
+    """
+    plan = []
+    for key, users in duplicates.items():
+        target = choose(users)
+        plan.append((key, target, [u for u in users if u['id'] != target['id']]))
+    return plan